@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import json
 import os
 from pathlib import Path
 
@@ -94,6 +95,14 @@ DATABASES = {
 }
 
 
+# Django REST framework
+# https://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'mailing.pagination.IdCursorPagination',
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -139,8 +148,95 @@ LOGIN_URL = '/admin/login/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-CELERY_BROKER_URL = 'redis://redis:6379'
+# tests tagged as slow run only with --tag slow
+TEST_RUNNER = 'core.test_runner.TestRunner'
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        # an unavailable redis turns into cache misses quickly
+        'OPTIONS': {
+            'socket_connect_timeout': 1,
+            'socket_timeout': 1,
+        },
+    },
+}
+
+CELERY_BROKER_URL = REDIS_URL
 CELERY_BROKER_CONNECTION_RETRY_ON_STARTUP = True
 CELERY_TIMEZONE = TIME_ZONE
+# redis hands a task not acknowledged within this many seconds over to
+# another worker, tasks waiting for their eta included
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': int(os.getenv('CELERY_VISIBILITY_TIMEOUT', 3600)),
+}
 
 CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+# Mailing dispatch
+# number of recipients handled by a single send_newsletter_chunk task
+MAILING_CHUNK_SIZE = int(os.getenv('MAILING_CHUNK_SIZE', 1000))
+# split a newsletter into a group of chunk tasks instead of sending
+# every message inside the send_newsletter task itself
+MAILING_FAN_OUT = os.getenv('MAILING_FAN_OUT', 'false').lower() == 'true'
+# in the fan-out mode chunks of these mobile operator codes, e.g.
+# "903,916", go to queues of their own, mailing.send.<code>, the others
+# to mailing.send
+MAILING_OPERATOR_QUEUES = [code for code in os.getenv('MAILING_OPERATOR_QUEUES', '').split(',') if code]
+# newsletters of at most N recipients are sent through the
+# mailing.priority queue instead
+MAILING_PRIORITY_MAX_RECIPIENTS = int(os.getenv('MAILING_PRIORITY_MAX_RECIPIENTS', 1000))
+# number of requests a worker process keeps in flight to the message gateway
+MAILING_GATEWAY_CONCURRENCY = int(os.getenv('MAILING_GATEWAY_CONCURRENCY', 100))
+# message statuses are written back every N results or every T milliseconds
+MAILING_STATUS_FLUSH_SIZE = int(os.getenv('MAILING_STATUS_FLUSH_SIZE', 500))
+MAILING_STATUS_FLUSH_INTERVAL = int(os.getenv('MAILING_STATUS_FLUSH_INTERVAL', 1000))
+# number of validated rows sent to postgres with a single COPY during import
+MAILING_IMPORT_BATCH_SIZE = int(os.getenv('MAILING_IMPORT_BATCH_SIZE', 50000))
+# messages per second per gateway class and mobile operator code, e.g.
+# {"MessageGateway": {"default": 100, "903": 20}}, no limits by default
+MAILING_RATE_LIMITS = json.loads(os.getenv('MAILING_RATE_LIMITS', '{}'))
+# how many times a message is resent after a 429 response
+MAILING_THROTTLED_RETRIES = int(os.getenv('MAILING_THROTTLED_RETRIES', 3))
+# longest Retry-After (in seconds) a worker waits for, longer ones leave the
+# message to the backoff retry; (MAILING_THROTTLED_RETRIES + 1) times it
+# must stay well below the CELERY_VISIBILITY_TIMEOUT
+MAILING_MAX_RETRY_AFTER = int(os.getenv('MAILING_MAX_RETRY_AFTER', 60))
+# failed messages are resent with exponential backoff (in seconds) and
+# moved to the dead status after the last attempt
+MAILING_RETRY_MAX_ATTEMPTS = int(os.getenv('MAILING_RETRY_MAX_ATTEMPTS', 5))
+MAILING_RETRY_BASE_DELAY = int(os.getenv('MAILING_RETRY_BASE_DELAY', 30))
+MAILING_RETRY_MAX_DELAY = int(os.getenv('MAILING_RETRY_MAX_DELAY', 3600))
+# tasks waiting for a retry or a delivery window are published at most
+# this many seconds ahead and then again, it must stay below the
+# CELERY_VISIBILITY_TIMEOUT
+MAILING_MAX_ETA = int(os.getenv('MAILING_MAX_ETA', 1800))
+# 'beat' creates a one-off periodic task per newsletter, 'poller' runs a
+# single periodic task that dispatches due newsletters
+MAILING_SCHEDULER = os.getenv('MAILING_SCHEDULER', 'beat')
+# seconds between dispatch_due_newsletters runs and newsletters claimed per run
+MAILING_POLL_INTERVAL = int(os.getenv('MAILING_POLL_INTERVAL', 10))
+MAILING_POLL_BATCH_SIZE = int(os.getenv('MAILING_POLL_BATCH_SIZE', 100))
+# messages are partitioned by month, partitions are created this many
+# months ahead and archived after MAILING_MESSAGE_RETENTION_MONTHS months
+MAILING_MESSAGE_PARTITIONS_AHEAD = int(os.getenv('MAILING_MESSAGE_PARTITIONS_AHEAD', 2))
+MAILING_MESSAGE_RETENTION_MONTHS = int(os.getenv('MAILING_MESSAGE_RETENTION_MONTHS', 12))
+# seconds the customer and newsletter detail responses are cached for
+MAILING_RESPONSE_CACHE_TIMEOUT = int(os.getenv('MAILING_RESPONSE_CACHE_TIMEOUT', 300))
+# port of the metrics endpoint started by celery workers, 0 disables it
+MAILING_METRICS_PORT = int(os.getenv('MAILING_METRICS_PORT', 9808))
+
+CELERY_BEAT_SCHEDULE = {
+    'create-message-partitions': {
+        'task': 'mailing.tasks.create_message_partitions',
+        'schedule': 24 * 60 * 60,
+    },
+}
+if MAILING_SCHEDULER == 'poller':
+    CELERY_BEAT_SCHEDULE['dispatch-due-newsletters'] = {
+        'task': 'mailing.tasks.dispatch_due_newsletters',
+        'schedule': MAILING_POLL_INTERVAL,
+    }
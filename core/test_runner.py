@@ -0,0 +1,12 @@
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Tests tagged as slow are skipped unless asked for with --tag slow.
+    """
+
+    def __init__(self, *args, tags=None, exclude_tags=None, **kwargs):
+        if not tags or 'slow' not in tags:
+            exclude_tags = {*(exclude_tags or ()), 'slow'}
+        super().__init__(*args, tags=tags, exclude_tags=exclude_tags, **kwargs)
@@ -1,24 +1,106 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
 
 from .models import Customer, MailingTask, Message, Newsletter
 
 
+class ApproximateCountPaginator(Paginator):
+    """
+    Counts an unfiltered changelist from the planner statistics instead of
+    a COUNT(*) over the whole table once the table is large enough.
+    """
+    # below this estimate the exact count is cheap enough
+    approximate_count_threshold = 100_000
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is None or query.where:
+            return super().count
+        estimate = _get_estimated_rows(self.object_list.model._meta.db_table)
+        if estimate < self.approximate_count_threshold:
+            return super().count
+        return estimate
+
+
+class NewsletterListFilter(admin.RelatedFieldListFilter):
+    """
+    Offers the most recent newsletters only, any other one is still
+    filtered by its id in the query string, e.g. ?newsletter__id__exact=1.
+    """
+    choices_limit = 50
+
+    def field_choices(self, field, request, model_admin):
+        # Newsletter.__str__ shows the stats counters
+        newsletters = Newsletter.objects.select_related('stats').order_by('-id')
+        choices = list(newsletters[:self.choices_limit])
+        if self.lookup_val and self.lookup_val.isdigit() and all(
+                str(newsletter.id) != self.lookup_val for newsletter in choices
+        ):
+            # the selected newsletter is older
+            choices.extend(newsletters.filter(id=self.lookup_val))
+        return [(newsletter.id, str(newsletter)) for newsletter in choices]
+
+
 class MailingTaskInLine(admin.StackedInline):
     model = MailingTask
 
 
 @admin.register(Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    pass
+    list_display = ['id', 'phone_number', 'mobile_operator_code', 'tag', 'timezone']
+    # exact match goes through the unique index on phone_number
+    search_fields = ['=phone_number']
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Newsletter)
 class NewsletterAdmin(admin.ModelAdmin):
+    list_display = ['id', 'start', 'finish', 'dynamic_audience', 'success', 'failure', 'dead', 'messages']
+    list_select_related = ['stats']
+    raw_id_fields = ['customers']
     inlines = [
         MailingTaskInLine,
     ]
 
+    @admin.display(ordering='stats__success')
+    def success(self, newsletter):
+        return newsletter.stats.success
+
+    @admin.display(ordering='stats__failure')
+    def failure(self, newsletter):
+        return newsletter.stats.failure
+
+    @admin.display(ordering='stats__dead')
+    def dead(self, newsletter):
+        return newsletter.stats.dead
+
+    @admin.display()
+    def messages(self, newsletter):
+        return newsletter.stats.total
+
 
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    pass
+    list_display = ['id', 'newsletter_id', 'customer', 'status', 'attempts', 'created_at']
+    list_select_related = ['customer']
+    # both filters go through message_status_idx and message_recipient_uniq
+    list_filter = ['status', ('newsletter', NewsletterListFilter)]
+    raw_id_fields = ['newsletter', 'customer']
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+
+
+def _get_estimated_rows(table: str) -> int:
+    # a partitioned table has no statistics of its own, its partitions have
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT coalesce(sum(greatest(c.reltuples, 0)), 0)::bigint FROM pg_class AS c '
+            "WHERE (c.oid = %s::regclass AND c.relkind <> 'p') "
+            'OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)',
+            [table, table],
+        )
+        return cursor.fetchone()[0]
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MailingConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mailing'
+
+    def ready(self):
+        # connects the celery signals collecting dispatch metrics
+        from . import metrics  # noqa: F401
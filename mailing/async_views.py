@@ -0,0 +1,95 @@
+from django.db.models import QuerySet
+from django.http import Http404, HttpResponseBadRequest, JsonResponse
+from django.views import View
+from rest_framework.serializers import Serializer
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from .models import Customer, Newsletter
+from .pagination import IdCursorPagination
+from .serializers import (CustomerSerializer, NewsletterListSerializer,
+                          NewsletterStatsSerializer)
+from .views import annotate_customers_count
+
+
+class AsyncView(View):
+    """
+    Read-only JSON view that waits for the database without holding a
+    worker when served by core.asgi. The serializers only format objects
+    that have already been fetched with the async ORM.
+    """
+    queryset: QuerySet
+    serializer_class: type[Serializer]
+
+    def get_queryset(self) -> QuerySet:
+        # a fresh clone per request, as in GenericAPIView
+        return self.queryset.all()
+
+    async def get_object(self, pk: int):
+        try:
+            return await self.get_queryset().aget(pk=pk)
+        except self.get_queryset().model.DoesNotExist:
+            raise Http404
+
+    async def get_page(self, request) -> JsonResponse:
+        # keyset pagination by id, the async counterpart of IdCursorPagination
+        try:
+            after = int(request.GET.get('after', 0))
+            page_size = min(
+                int(request.GET.get(IdCursorPagination.page_size_query_param, IdCursorPagination.page_size)),
+                IdCursorPagination.max_page_size,
+            )
+        except ValueError:
+            return HttpResponseBadRequest('after and page_size must be integers')
+
+        objects = [obj async for obj in self.get_queryset().filter(id__gt=after).order_by('id')[:page_size + 1]]
+        next_url = None
+        if len(objects) > page_size:
+            objects = objects[:page_size]
+            next_url = replace_query_param(request.build_absolute_uri(), 'after', objects[-1].id)
+        return self.render({
+            'next': next_url,
+            'results': self.serializer_class(objects, many=True).data,
+        })
+
+    def render(self, data) -> JsonResponse:
+        return JsonResponse(data, encoder=JSONEncoder, safe=False)
+
+
+class NewsletterListView(AsyncView):
+    queryset = Newsletter.objects.all()
+    serializer_class = NewsletterListSerializer
+
+    def get_queryset(self) -> QuerySet:
+        return annotate_customers_count(super().get_queryset())
+
+    async def get(self, request):
+        return await self.get_page(request)
+
+
+class NewsletterStatsView(AsyncView):
+    queryset = Newsletter.objects.select_related('stats')
+    serializer_class = NewsletterStatsSerializer
+
+    async def get(self, request, pk: int | None = None):
+        if pk is None:
+            return await self.get_page(request)
+        return self.render(self.serializer_class(await self.get_object(pk)).data)
+
+
+class CustomerView(AsyncView):
+    queryset = Customer.objects.all()
+    serializer_class = CustomerSerializer
+
+    async def get(self, request, pk: int | None = None):
+        if pk is not None:
+            return self.render(self.serializer_class(await self.get_object(pk)).data)
+        # lookup by the unique phone number
+        phone_number = request.GET.get('phone_number')
+        if not phone_number:
+            return HttpResponseBadRequest('phone_number is required')
+        try:
+            customer = await self.get_queryset().aget(phone_number=phone_number)
+        except Customer.DoesNotExist:
+            raise Http404
+        return self.render(self.serializer_class(customer).data)
@@ -0,0 +1,249 @@
+import contextlib
+import dataclasses
+import datetime
+import random
+import resource
+import statistics
+import threading
+import time
+import zoneinfo
+from collections.abc import Iterator
+from unittest import mock
+
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from .message_gateway import AbstractMessageGateway, ConcurrentMessageGateway
+from .message_template import MessageTemplate
+from .models import Customer, Newsletter
+from .recipients import Recipient
+from .status_writer import MessageStatusWriter
+
+BENCHMARK_TAG = 'benchmark'
+BENCHMARK_MOBILE_OPERATOR_CODE = '900'
+BENCHMARK_TIMEZONES = ['Europe/Moscow', 'Asia/Yekaterinburg', 'Asia/Novosibirsk', 'Asia/Vladivostok']
+
+
+class FakeMessageGateway(AbstractMessageGateway):
+    """
+    In-process gateway answering after `latency` seconds and failing
+    `error_rate` of the messages as well as the ones sent to
+    `failing_phone_numbers`. Sent messages are kept in `sent` if recorded.
+    """
+    latency: float = 0
+    error_rate: float = 0
+    failing_phone_numbers: set[str] = set()
+    # (message_id, phone_number, text), None unless recorded
+    sent: list[tuple[int, str, str]] | None = None
+    latencies: list[float] = []
+    _lock = threading.Lock()
+
+    @classmethod
+    def reset(
+            cls,
+            latency: float = 0,
+            error_rate: float = 0,
+            failing_phone_numbers: set[str] | None = None,
+            record: bool = False,
+    ) -> None:
+        cls.latency = latency
+        cls.error_rate = error_rate
+        cls.failing_phone_numbers = failing_phone_numbers or set()
+        cls.sent = [] if record else None
+        cls.latencies = []
+
+    @classmethod
+    def send_message(
+            cls,
+            message_id: int,
+            customer_phone_number: str,
+            newsletter_message_text: str,
+    ) -> bool:
+        started_at = time.perf_counter()
+        if cls.latency:
+            time.sleep(cls.latency)
+        result = (
+            customer_phone_number not in cls.failing_phone_numbers
+            and random.random() >= cls.error_rate
+        )
+        with cls._lock:
+            cls.latencies.append(time.perf_counter() - started_at)
+            if cls.sent is not None:
+                cls.sent.append((message_id, customer_phone_number, newsletter_message_text))
+        return result
+
+
+class ConcurrentFakeMessageGateway(FakeMessageGateway):
+    iter_send_messages = classmethod(ConcurrentMessageGateway.iter_send_messages.__func__)
+
+
+class DispatchTimer:
+    """
+    Times every message from the start of its chunk in send_messages until
+    its status is written by MessageStatusWriter, so the latency covers the
+    whole dispatch path and not only the gateway.
+    """
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self._chunk_started_at = 0.0
+
+    @contextlib.contextmanager
+    def patch(self) -> Iterator[None]:
+        from . import tasks
+
+        send_messages = tasks.send_messages
+        timer = self
+
+        def timed_send_messages(*args, **kwargs):
+            timer._chunk_started_at = time.perf_counter()
+            return send_messages(*args, **kwargs)
+
+        class TimedMessageStatusWriter(MessageStatusWriter):
+
+            def flush(self) -> None:
+                flushed = len(self._statuses)
+                super().flush()
+                timer.latencies.extend([time.perf_counter() - timer._chunk_started_at] * flushed)
+
+        with (
+            mock.patch.object(tasks, 'send_messages', timed_send_messages),
+            mock.patch.object(tasks, 'MessageStatusWriter', TimedMessageStatusWriter),
+        ):
+            yield
+
+
+@dataclasses.dataclass
+class DispatchBenchmarkResult:
+    messages: int
+    seconds: float
+    queries: int
+    latency_p50: float
+    latency_p99: float
+    # growth of the peak resident set size while sending, in bytes
+    peak_memory_growth: int
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0
+
+    @property
+    def queries_per_message(self) -> float:
+        return self.queries / self.messages if self.messages else 0
+
+
+def run_dispatch_benchmark(
+        customers: int,
+        newsletters: int,
+        latency: float = 0,
+        error_rate: float = 0,
+        concurrent: bool = False,
+        keep: bool = False,
+) -> DispatchBenchmarkResult:
+    """
+    Seed `customers` customers and `newsletters` newsletters targeting
+    all of them, then send every newsletter in-process through a fake
+    gateway. The send runs in autocommit as it does in a worker, the
+    seeded data is deleted afterwards unless `keep` is set.
+    """
+    # imported here, the benchmark measures the tasks module as it is
+    from .tasks import send_newsletter
+
+    gateway = ConcurrentFakeMessageGateway if concurrent else FakeMessageGateway
+    gateway.reset(latency=latency, error_rate=error_rate)
+    timer = DispatchTimer()
+
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    last_customer_id = Customer.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    with transaction.atomic():
+        newsletter_ids = _seed(customers, newsletters)
+
+    try:
+        # failed messages are marked dead right away, retries would be
+        # published to the broker
+        with override_settings(MAILING_RETRY_MAX_ATTEMPTS=1), timer.patch():
+            # ru_maxrss is in KiB on Linux and never goes down
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            started_at = time.perf_counter()
+            with connection.execute_wrapper(count_queries):
+                for newsletter_id in newsletter_ids:
+                    send_newsletter(newsletter_id, gateway, fan_out=False)
+            seconds = time.perf_counter() - started_at
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        if not keep:
+            with transaction.atomic():
+                _clean_up(newsletter_ids, last_customer_id)
+
+    latencies = timer.latencies or [0]
+    return DispatchBenchmarkResult(
+        messages=len(timer.latencies),
+        seconds=seconds,
+        queries=queries,
+        latency_p50=statistics.median(latencies),
+        latency_p99=statistics.quantiles(latencies, n=100)[-1] if len(latencies) > 1 else latencies[0],
+        peak_memory_growth=(rss_after - rss_before) * 1024,
+    )
+
+
+def _seed(customers: int, newsletters: int) -> list[int]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {Customer._meta.db_table} '
+            f'(phone_number, mobile_operator_code, tag, timezone, created_at, updated_at) '
+            f'SELECT (70000000000 + i)::text, %s, %s, %s, now(), now() '
+            f'FROM generate_series(1, %s) AS i '
+            f'ON CONFLICT (phone_number) DO NOTHING',
+            [BENCHMARK_MOBILE_OPERATOR_CODE, BENCHMARK_TAG, 'Europe/Moscow', customers],
+        )
+
+    # the newsletters are committed, they are created as already dispatched
+    # and without a periodic task, so no scheduler sends them for real
+    now = timezone.now()
+    with override_settings(MAILING_SCHEDULER='poller'):
+        return [
+            Newsletter.objects.create(
+                start=now,
+                finish=now + datetime.timedelta(days=1),
+                message_text=f'Benchmark newsletter {i}',
+                mobile_operator_codes=[BENCHMARK_MOBILE_OPERATOR_CODE],
+                tags=[BENCHMARK_TAG],
+                dispatched_at=now,
+            ).id
+            for i in range(newsletters)
+        ]
+
+
+def _clean_up(newsletter_ids: list[int], last_customer_id: int) -> None:
+    # customers that existed before the benchmark are kept
+    Newsletter.objects.filter(id__in=newsletter_ids).delete()
+    Customer.objects.filter(id__gt=last_customer_id, tag=BENCHMARK_TAG).delete()
+
+
+def run_template_benchmark(text: str, messages: int = 100_000) -> float:
+    """
+    Render `text` for `messages` recipients spread over a few time zones,
+    returns the seconds taken including the template compilation.
+    """
+    recipients = [
+        Recipient(
+            i,
+            str(70000000000 + i),
+            BENCHMARK_MOBILE_OPERATOR_CODE,
+            BENCHMARK_TAG,
+            zoneinfo.ZoneInfo(BENCHMARK_TIMEZONES[i % len(BENCHMARK_TIMEZONES)]),
+        )
+        for i in range(messages)
+    ]
+    started_at = time.perf_counter()
+    render = MessageTemplate(text).renderer(timezone.now())
+    for recipient in recipients:
+        render(recipient)
+    return time.perf_counter() - started_at
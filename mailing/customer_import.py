@@ -0,0 +1,136 @@
+import csv
+import dataclasses
+import functools
+import io
+import json
+import zoneinfo
+from collections.abc import Iterator
+from typing import IO
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from . import response_cache
+from .models import Customer
+from .serializers import PHONE_NUMBER_PATTERN
+
+FILE_FORMATS = ('csv', 'jsonl')
+STAGING_TABLE = 'mailing_customer_import'
+STAGING_COLUMNS = ('row_number', 'phone_number', 'mobile_operator_code', 'tag', 'timezone')
+# keep the response bounded for files with lots of invalid rows
+MAX_REPORTED_ERRORS = 100
+
+
+@dataclasses.dataclass
+class CustomerImportResult:
+    imported: int = 0
+    invalid: int = 0
+    errors: list[dict] = dataclasses.field(default_factory=list)
+
+
+def import_customers(stream: IO[str], file_format: str) -> CustomerImportResult:
+    """
+    Validate customers from a CSV/JSONL stream, load them through COPY
+    into a staging table and upsert them on phone_number.
+    """
+    result = CustomerImportResult()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE {STAGING_TABLE} ('
+            f'row_number integer, phone_number varchar(11), mobile_operator_code varchar(3), '
+            f'tag varchar(30), timezone varchar(63))'
+        )
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        rows = 0
+        for row_number, row in enumerate(_read_rows(stream, file_format), start=1):
+            errors = _validate_row(row)
+            if errors:
+                result.invalid += 1
+                if len(result.errors) < MAX_REPORTED_ERRORS:
+                    result.errors.append({'row': row_number, 'errors': errors})
+                continue
+
+            writer.writerow([row_number, *(row[column] for column in STAGING_COLUMNS[1:])])
+            rows += 1
+            if rows == settings.MAILING_IMPORT_BATCH_SIZE:
+                _copy(cursor, buffer)
+                rows = 0
+        _copy(cursor, buffer)
+
+        # the last occurrence of a phone number in the file wins
+        now = timezone.now()
+        cursor.execute(
+            f'INSERT INTO {Customer._meta.db_table} '
+            f'(phone_number, mobile_operator_code, tag, timezone, created_at, updated_at) '
+            f'SELECT DISTINCT ON (phone_number) '
+            f'phone_number, mobile_operator_code, tag, timezone, %s, %s '
+            f'FROM {STAGING_TABLE} ORDER BY phone_number, row_number DESC '
+            f'ON CONFLICT (phone_number) DO UPDATE SET '
+            f'mobile_operator_code = EXCLUDED.mobile_operator_code, '
+            f'tag = EXCLUDED.tag, '
+            f'timezone = EXCLUDED.timezone, '
+            f'updated_at = EXCLUDED.updated_at',
+            [now, now],
+        )
+        result.imported = cursor.rowcount
+        response_cache.invalidate_all('customer')
+
+        Customer.objects.filter(
+            phone_number__in=RawSQL(f'SELECT phone_number FROM {STAGING_TABLE}', []),
+        ).sync_newsletters()
+        cursor.execute(f'DROP TABLE {STAGING_TABLE}')
+    return result
+
+
+def _read_rows(stream: IO[str], file_format: str) -> Iterator[dict]:
+    if file_format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            row = None
+        yield row if isinstance(row, dict) else {}
+
+
+def _validate_row(row: dict) -> dict[str, str]:
+    errors = {}
+    for column in STAGING_COLUMNS[1:]:
+        value = row.get(column)
+        row[column] = '' if value is None else str(value).strip()
+
+    if not PHONE_NUMBER_PATTERN.match(row['phone_number']):
+        errors['phone_number'] = 'should be in the format 7XXXXXXXXXX'
+    if not row['mobile_operator_code'] or len(row['mobile_operator_code']) > 3:
+        errors['mobile_operator_code'] = 'should be from 1 to 3 characters long'
+    if not row['tag'] or len(row['tag']) > 30:
+        errors['tag'] = 'should be from 1 to 30 characters long'
+
+    row['timezone'] = row['timezone'] or str(Customer._meta.get_field('timezone').get_default())
+    if row['timezone'] not in _available_timezones():
+        errors['timezone'] = 'unknown time zone'
+    return errors
+
+
+@functools.cache
+def _available_timezones() -> set[str]:
+    return zoneinfo.available_timezones()
+
+
+def _copy(cursor, buffer: io.StringIO) -> None:
+    if not buffer.tell():
+        return
+    buffer.seek(0)
+    cursor.copy_expert(
+        f'COPY {STAGING_TABLE} ({", ".join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)',
+        buffer,
+    )
+    buffer.seek(0)
+    buffer.truncate()
@@ -0,0 +1,62 @@
+import csv
+import io
+import itertools
+from collections.abc import Iterator
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from .models import Message
+
+FILE_FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+REPORT_FIELDS = ('message_id', 'customer_id', 'phone_number', 'status', 'attempts', 'created_at', 'updated_at')
+# rows fetched from the server-side cursor and written out at once
+REPORT_CHUNK_SIZE = 2000
+
+
+def iter_delivery_report(newsletter_id: int, file_format: str) -> Iterator[str]:
+    """
+    Stream the messages of a newsletter with the customer phone number
+    as CSV or NDJSON, one chunk of rows at a time. Messages of archived
+    partitions are only kept as counters and aren't reported.
+    """
+    # the (newsletter, customer) index returns the rows already ordered,
+    # so they are streamed without sorting the whole newsletter first
+    rows = (
+        Message.objects
+        .filter(newsletter_id=newsletter_id)
+        .order_by('customer_id')
+        .values_list('id', 'customer_id', 'customer__phone_number', 'status', 'attempts', 'created_at', 'updated_at')
+        .iterator(chunk_size=REPORT_CHUNK_SIZE)
+    )
+    # outside of a transaction the cursor is declared WITH HOLD and the
+    # whole result is materialized by postgres before the first row
+    with transaction.atomic():
+        if file_format == 'csv':
+            yield from _iter_csv(rows)
+        else:
+            yield from _iter_ndjson(rows)
+
+
+def _iter_csv(rows: Iterator[tuple]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(REPORT_FIELDS)
+    while chunk := list(itertools.islice(rows, REPORT_CHUNK_SIZE)):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header of an empty report
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _iter_ndjson(rows: Iterator[tuple]) -> Iterator[str]:
+    encoder = DjangoJSONEncoder()
+    while chunk := list(itertools.islice(rows, REPORT_CHUNK_SIZE)):
+        yield ''.join(f'{encoder.encode(dict(zip(REPORT_FIELDS, row)))}\n' for row in chunk)
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mailing.partitions import archive_message_partitions, get_month_start
+
+
+class Command(BaseCommand):
+    help = 'Compact message partitions older than the retention period into per-newsletter counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months',
+            type=int,
+            default=settings.MAILING_MESSAGE_RETENTION_MONTHS,
+            help='months of messages to keep, not counting the current one',
+        )
+        parser.add_argument(
+            '--keep-detached',
+            action='store_true',
+            help='keep the detached partitions as standalone tables, e.g. to dump them',
+        )
+
+    def handle(self, *args, months: int, keep_detached: bool, **options):
+        before = get_month_start(timezone.now(), -months)
+        archived = archive_message_partitions(before, drop=not keep_detached)
+        for name in archived:
+            self.stdout.write(f'{name} has been archived')
+        self.stdout.write(self.style.SUCCESS(f'Archived {len(archived)} partitions created before {before:%Y-%m}'))
@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.benchmark import run_dispatch_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure newsletter dispatch throughput against an in-process fake gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=10000)
+        parser.add_argument('--newsletters', type=int, default=1)
+        parser.add_argument('--latency', type=float, default=0, help='gateway latency, ms')
+        parser.add_argument('--error-rate', type=float, default=0, help='share of failed messages, 0..1')
+        parser.add_argument(
+            '--concurrent',
+            action='store_true',
+            help='send through a thread pool like ConcurrentMessageGateway',
+        )
+        parser.add_argument(
+            '--keep',
+            action='store_true',
+            help='keep the seeded customers, newsletters and messages',
+        )
+
+    def handle(
+            self,
+            *args,
+            customers: int,
+            newsletters: int,
+            latency: float,
+            error_rate: float,
+            concurrent: bool,
+            keep: bool,
+            **options,
+    ):
+        if not 0 <= error_rate <= 1:
+            raise CommandError('--error-rate must be between 0 and 1')
+
+        result = run_dispatch_benchmark(
+            customers=customers,
+            newsletters=newsletters,
+            latency=latency / 1000,
+            error_rate=error_rate,
+            concurrent=concurrent,
+            keep=keep,
+        )
+
+        self.stdout.write(f'messages: {result.messages}')
+        self.stdout.write(f'seconds: {result.seconds:.3f}')
+        self.stdout.write(f'messages/sec: {result.messages_per_second:.1f}')
+        self.stdout.write(f'queries/message: {result.queries_per_message:.4f}')
+        self.stdout.write(f'latency p50: {result.latency_p50 * 1000:.3f} ms')
+        self.stdout.write(f'latency p99: {result.latency_p99 * 1000:.3f} ms')
+        self.stdout.write(f'peak memory growth: {result.peak_memory_growth / 2 ** 20:.1f} MiB')
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.benchmark import run_template_benchmark
+from mailing.message_template import TemplateError
+
+DEFAULT_TEXTS = [
+    'Newsletter without placeholders',
+    'Hi, {tag}!',
+    'Hi, {tag}! It is {local_time} on {local_date}, your number is {phone_number}',
+]
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost of rendering newsletter templates per 100k messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('texts', nargs='*', help='templates to render, a few samples by default')
+        parser.add_argument('--messages', type=int, default=100_000)
+
+    def handle(self, *args, texts: list[str], messages: int, **options):
+        for text in texts or DEFAULT_TEXTS:
+            try:
+                seconds = run_template_benchmark(text, messages)
+            except TemplateError as e:
+                raise CommandError(f'{text!r}: {e}')
+            self.stdout.write(
+                f'{text!r}: {seconds * 1000:.1f} ms per {messages} messages, '
+                f'{seconds / messages * 1_000_000:.3f} µs per message'
+            )
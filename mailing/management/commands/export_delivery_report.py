@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.delivery_report import FILE_FORMATS, iter_delivery_report
+from mailing.models import Newsletter
+
+
+class Command(BaseCommand):
+    help = 'Stream the per-message delivery report of a newsletter as CSV or NDJSON to stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('newsletter_id', type=int)
+        parser.add_argument(
+            '--format',
+            dest='file_format',
+            choices=FILE_FORMATS,
+            default='csv',
+        )
+
+    def handle(self, *args, newsletter_id: int, file_format: str, **options):
+        if not Newsletter.objects.filter(id=newsletter_id).exists():
+            raise CommandError(f'Newsletter {newsletter_id} does not exist')
+
+        for chunk in iter_delivery_report(newsletter_id, file_format):
+            self.stdout.write(chunk, ending='')
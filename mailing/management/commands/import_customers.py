@@ -0,0 +1,32 @@
+import pathlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.customer_import import FILE_FORMATS, import_customers
+
+
+class Command(BaseCommand):
+    help = 'Import customers from a CSV or JSONL file, upserting them on phone_number'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=pathlib.Path)
+        parser.add_argument(
+            '--format',
+            dest='file_format',
+            choices=FILE_FORMATS,
+            help='file format, detected from the file extension by default',
+        )
+
+    def handle(self, *args, path: pathlib.Path, file_format: str | None, **options):
+        file_format = file_format or path.suffix.lstrip('.').lower()
+        if file_format not in FILE_FORMATS:
+            raise CommandError(f'Unsupported file format: {file_format}')
+
+        with path.open(encoding='utf-8-sig', newline='') as stream:
+            result = import_customers(stream, file_format)
+
+        for error in result.errors:
+            self.stderr.write(f'row {error["row"]}: {error["errors"]}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result.imported} customers, skipped {result.invalid} invalid rows'
+        ))
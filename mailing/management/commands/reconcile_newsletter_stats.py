@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from mailing.models import NewsletterStats
+
+
+class Command(BaseCommand):
+    help = 'Recompute newsletter stats counters from the messages table'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'newsletter_ids',
+            nargs='*',
+            type=int,
+            help='newsletters to reconcile, all of them by default',
+        )
+
+    def handle(self, *args, newsletter_ids: list[int], **options):
+        NewsletterStats.objects.reconcile(newsletter_ids or None)
+        self.stdout.write(self.style.SUCCESS('Newsletter stats have been reconciled'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mailing.models import Newsletter
+from mailing.tasks import resume_newsletter
+
+
+class Command(BaseCommand):
+    help = 'Continue an interrupted newsletter dispatch from its last checkpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('newsletter_id', type=int)
+
+    def handle(self, *args, newsletter_id: int, **options):
+        if not Newsletter.objects.filter(id=newsletter_id).exists():
+            raise CommandError(f'Newsletter {newsletter_id} does not exist')
+
+        resume_newsletter.delay(newsletter_id)
+        self.stdout.write(self.style.SUCCESS(f'Newsletter {newsletter_id} dispatch has been resumed'))
@@ -1,14 +1,37 @@
 import abc
 import os
+import time
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import NamedTuple
 
 import requests
 from celery.utils.log import get_task_logger
-from requests import ConnectTimeout
+from django.conf import settings
+from requests import RequestException, Timeout
+from requests.adapters import HTTPAdapter
 from rest_framework import status
 
+from . import metrics
+from .rate_limiter import get_rate_limiter
+
 logger = get_task_logger(__name__)
 
 
+class OutgoingMessage(NamedTuple):
+    id: int
+    phone_number: str
+    text: str
+    mobile_operator_code: str = ''
+
+
+class GatewayThrottled(Exception):
+
+    def __init__(self, retry_after: float):
+        super().__init__(f'Throttled, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
 class AbstractMessageGateway(abc.ABC):
 
     @classmethod
@@ -21,8 +44,56 @@ class AbstractMessageGateway(abc.ABC):
     ) -> bool:
         raise NotImplementedError
 
+    @classmethod
+    def iter_send_messages(
+            cls,
+            messages: Iterable[OutgoingMessage],
+    ) -> Iterator[tuple[int, bool]]:
+        # yields (message_id, result) pairs as soon as they are known
+        for message in messages:
+            yield message.id, cls.send_limited(message)
+
+    @classmethod
+    def send_limited(cls, message: OutgoingMessage) -> bool:
+        # respect the shared rate limit and back off every worker when
+        # the gateway throttles us
+        rate_limiter = get_rate_limiter(cls, message.mobile_operator_code)
+        for _ in range(settings.MAILING_THROTTLED_RETRIES + 1):
+            if rate_limiter:
+                rate_limiter.acquire()
+            try:
+                return cls.send_message(message.id, message.phone_number, message.text)
+            except GatewayThrottled as e:
+                logger.info(f'{e}, message_id: {message.id}')
+                if e.retry_after > settings.MAILING_MAX_RETRY_AFTER:
+                    # holding the chunk that long would outlive the broker
+                    # visibility timeout, the message is retried with backoff
+                    return False
+                if rate_limiter:
+                    rate_limiter.block(e.retry_after)
+                else:
+                    time.sleep(e.retry_after)
+        return False
+
+    @classmethod
+    def send_messages(cls, messages: Iterable[OutgoingMessage]) -> dict[int, bool]:
+        return dict(cls.iter_send_messages(messages))
+
 
 class MessageGateway(AbstractMessageGateway):
+    _session: requests.Session | None = None
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        # one keep-alive connection pool per process, created lazily so
+        # that it is never shared between forked celery workers
+        if MessageGateway._session is None:
+            session = requests.Session()
+            session.headers['Authorization'] = os.getenv('PROBE_FBRQ_JWT_TOKEN')
+            adapter = HTTPAdapter(pool_maxsize=settings.MAILING_GATEWAY_CONCURRENCY)
+            session.mount('https://', adapter)
+            MessageGateway._session = session
+        return MessageGateway._session
 
     @classmethod
     def send_message(
@@ -38,23 +109,62 @@ class MessageGateway(AbstractMessageGateway):
             f'| newsletter_message_text: {newsletter_message_text}')
 
         url = f'https://probe.fbrq.cloud/v1/send/{message_id}'
-        headers = {
-            'Authorization': os.getenv('PROBE_FBRQ_JWT_TOKEN')
-        }
         data = {
             'id': message_id,
             'phone': int(customer_phone_number),
             'text': newsletter_message_text,
         }
+        started_at = time.perf_counter()
         try:
-            response = requests.post(url, headers=headers, json=data, timeout=5)
-        except ConnectTimeout:
-            logger.info(f'ConnectTimeout, message_id: {message_id}')
+            response = cls.get_session().post(url, json=data, timeout=5)
+        except RequestException as e:
+            # timeouts and connection errors are retried later
+            logger.info(f'{e.__class__.__name__}, message_id: {message_id}')
+            _observe_request(cls, 'timeout' if isinstance(e, Timeout) else 'error', started_at)
             return False
 
+        if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS:
+            _observe_request(cls, 'throttled', started_at)
+            raise GatewayThrottled(_parse_retry_after(response.headers.get('Retry-After')))
+
         if response.status_code != status.HTTP_200_OK:
             logger.info(f'{response.status_code} {response.text}')
+            _observe_request(cls, 'failure', started_at)
             return False
 
         logger.info(f'{response.status_code} {response.json()}')
+        _observe_request(cls, 'success', started_at)
         return True
+
+
+class ConcurrentMessageGateway(MessageGateway):
+    """
+    Sends a batch of messages through the pooled session keeping up to
+    MAILING_GATEWAY_CONCURRENCY requests in flight.
+    """
+
+    @classmethod
+    def iter_send_messages(
+            cls,
+            messages: Iterable[OutgoingMessage],
+    ) -> Iterator[tuple[int, bool]]:
+        with ThreadPoolExecutor(max_workers=settings.MAILING_GATEWAY_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(cls.send_limited, message): message.id
+                for message in messages
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+
+def _observe_request(gateway: type, outcome: str, started_at: float) -> None:
+    metrics.GATEWAY_REQUEST_SECONDS.labels(gateway.__name__).observe(time.perf_counter() - started_at)
+    metrics.GATEWAY_REQUESTS.labels(gateway.__name__, outcome).inc()
+
+
+def _parse_retry_after(retry_after: str | None) -> float:
+    # Retry-After may also be an HTTP date, fall back to a second then
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return 1
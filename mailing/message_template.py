@@ -0,0 +1,97 @@
+import datetime
+import functools
+import operator
+import string
+from collections.abc import Callable
+
+from .recipients import Recipient
+
+# placeholders taken as they are from the recipient tuple
+RECIPIENT_PLACEHOLDERS = ('phone_number', 'mobile_operator_code', 'tag')
+# placeholders computed from the send time in the recipient time zone
+LOCAL_TIME_PLACEHOLDERS = {
+    'local_time': '%H:%M',
+    'local_date': '%Y-%m-%d',
+}
+PLACEHOLDERS = (*RECIPIENT_PLACEHOLDERS, *LOCAL_TIME_PLACEHOLDERS)
+ESCAPING_HINT = 'literal braces are written doubled: {{ and }}'
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class MessageTemplate:
+    """
+    Newsletter text with str.format placeholders, e.g. 'Hi, {tag}! It is
+    {local_time}', braces are escaped by doubling them. The text is parsed
+    once, rendering is a single str.format call per recipient.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        format_parts = []
+        self.placeholders = []
+        try:
+            parsed = list(string.Formatter().parse(text))
+        except ValueError as e:
+            raise TemplateError(f'{e}, {ESCAPING_HINT}') from e
+        for literal, placeholder, format_spec, conversion in parsed:
+            format_parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if placeholder is None:
+                continue
+            if placeholder not in PLACEHOLDERS:
+                raise TemplateError(
+                    f'unknown placeholder {{{placeholder}}}, use one of: '
+                    f'{", ".join(f"{{{name}}}" for name in PLACEHOLDERS)}, {ESCAPING_HINT}'
+                )
+            if format_spec or conversion:
+                raise TemplateError(f'placeholder {{{placeholder}}} can\'t have a format spec or conversion')
+            format_parts.append(f'{{{len(self.placeholders)}}}')
+            self.placeholders.append(placeholder)
+        self._format = ''.join(format_parts)
+
+    def renderer(self, now: datetime.datetime) -> Callable[[Recipient], str]:
+        # local times are computed once per time zone for a whole batch
+        if not self.placeholders:
+            text = self._format.format()
+            return lambda recipient: text
+
+        getters = [self._get_getter(placeholder, now) for placeholder in self.placeholders]
+        format_text = self._format.format
+
+        if len(getters) == 1:
+            getter = getters[0]
+            return lambda recipient: format_text(getter(recipient))
+        return lambda recipient: format_text(*[getter(recipient) for getter in getters])
+
+    def render(self, recipient: Recipient, now: datetime.datetime) -> str:
+        return self.renderer(now)(recipient)
+
+    @staticmethod
+    def _get_getter(placeholder: str, now: datetime.datetime) -> Callable[[Recipient], str]:
+        if placeholder in RECIPIENT_PLACEHOLDERS:
+            return operator.attrgetter(placeholder)
+
+        time_format = LOCAL_TIME_PLACEHOLDERS[placeholder]
+        local_times = {}
+
+        def get_local_time(recipient: Recipient) -> str:
+            try:
+                return local_times[recipient.timezone]
+            except KeyError:
+                local_time = local_times[recipient.timezone] = now.astimezone(recipient.timezone).strftime(time_format)
+                return local_time
+
+        return get_local_time
+
+
+def escape(text: str) -> str:
+    # a template rendered as the text itself
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+@functools.lru_cache(maxsize=128)
+def get_message_template(text: str) -> MessageTemplate:
+    # compiled once per worker process for every chunk of a newsletter
+    return MessageTemplate(text)
@@ -0,0 +1,94 @@
+import os
+import time
+
+from celery import signals
+from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from prometheus_client import (REGISTRY, CollectorRegistry, Counter, Gauge,
+                               Histogram, multiprocess, start_http_server)
+
+logger = get_task_logger(__name__)
+
+GATEWAY_REQUEST_SECONDS = Histogram(
+    'mailing_gateway_request_seconds',
+    'Time spent waiting for the message gateway',
+    ['gateway'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10),
+)
+GATEWAY_REQUESTS = Counter(
+    'mailing_gateway_requests',
+    'Gateway requests by outcome: success, failure, throttled, timeout or error',
+    ['gateway', 'outcome'],
+)
+MESSAGES = Counter(
+    'mailing_messages',
+    'Messages written by the dispatch path by status',
+    ['status'],
+)
+BATCH_SIZE = Histogram(
+    'mailing_batch_size',
+    'Number of messages sent to the gateway at once',
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+DISPATCH_SECONDS = Histogram(
+    'mailing_dispatch_seconds',
+    'Duration of the dispatch tasks',
+    ['task'],
+    buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900, 3600),
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    'mailing_task_queue_wait_seconds',
+    'Time a dispatch task waited in the queue past its publish time or eta',
+    ['task'],
+    buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300),
+)
+# every worker process sets the latest counters read from newsletter stats
+NEWSLETTER_PROGRESS = Gauge(
+    'mailing_newsletter_progress',
+    'Messages of a newsletter by status',
+    ['newsletter_id', 'status'],
+    multiprocess_mode='mostrecent',
+)
+
+PUBLISHED_AT_HEADER = 'mailing_published_at'
+
+
+@signals.before_task_publish.connect
+def _add_published_at(headers: dict, **kwargs) -> None:
+    headers.setdefault(PUBLISHED_AT_HEADER, time.time())
+
+
+@signals.task_prerun.connect
+def _observe_queue_wait(task, **kwargs) -> None:
+    if not task.name.startswith('mailing.'):
+        return
+    published_at = getattr(task.request, PUBLISHED_AT_HEADER, None)
+    if published_at is None:
+        return
+    # tasks with an eta or a countdown are only due at their eta
+    eta = task.request.eta
+    if eta:
+        published_at = max(published_at, parse_datetime(eta).timestamp())
+    TASK_QUEUE_WAIT_SECONDS.labels(task.name).observe(max(time.time() - published_at, 0))
+
+
+@signals.worker_init.connect
+def _start_metrics_server(**kwargs) -> None:
+    # the pool processes write their samples to PROMETHEUS_MULTIPROC_DIR,
+    # the main worker process serves them all
+    if not settings.MAILING_METRICS_PORT:
+        return
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(settings.MAILING_METRICS_PORT, registry=registry)
+    logger.info(f'Serving metrics on port {settings.MAILING_METRICS_PORT}')
+
+
+@signals.worker_process_shutdown.connect
+def _mark_process_dead(pid: int, **kwargs) -> None:
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='dynamic_audience',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.5 on 2026-10-16 23:58
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0002_newsletter_dynamic_audience'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['mobile_operator_code', 'tag'], name='customer_segment_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newsletter',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['mobile_operator_codes'], name='newsletter_operator_codes_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newsletter',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tags'], name='newsletter_tags_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='newsletter',
+            index=models.Index(fields=['finish'], name='newsletter_finish_idx'),
+        ),
+    ]
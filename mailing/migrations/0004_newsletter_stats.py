@@ -0,0 +1,40 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:00
+
+import django.db.models.deletion
+import django_prometheus.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0003_segment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NewsletterStats',
+            fields=[
+                ('newsletter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='mailing.newsletter')),
+                ('success', models.IntegerField(default=0)),
+                ('ongoing', models.IntegerField(default=0)),
+                ('failure', models.IntegerField(default=0)),
+                ('canceled', models.IntegerField(default=0)),
+            ],
+            bases=(django_prometheus.models.ExportModelOperationsMixin('newsletter_stats'), models.Model),
+        ),
+        migrations.RunSQL(
+            sql="""
+                INSERT INTO mailing_newsletterstats (newsletter_id, success, ongoing, failure, canceled)
+                SELECT n.id,
+                       count(m.id) FILTER (WHERE m.status = 'success'),
+                       count(m.id) FILTER (WHERE m.status = 'ongoing'),
+                       count(m.id) FILTER (WHERE m.status = 'failure'),
+                       count(m.id) FILTER (WHERE m.status = 'canceled')
+                FROM mailing_newsletter AS n
+                LEFT JOIN mailing_message AS m ON m.newsletter_id = n.id
+                GROUP BY n.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0004_newsletter_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='newsletterstats',
+            name='dead',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='status',
+            field=models.CharField(choices=[('success', 'Success'), ('ongoing', 'Ongoing'), ('failure', 'Failure'), ('canceled', 'Canceled'), ('dead', 'Dead')], default='ongoing', max_length=10),
+        ),
+        migrations.RunSQL(
+            sql="UPDATE mailing_message SET attempts = 1 WHERE status IN ('success', 'failure')",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:04
+
+import django.db.models.deletion
+import django.utils.timezone
+import django_prometheus.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0005_message_retries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DispatchCheckpoint',
+            fields=[
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('newsletter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='checkpoint', serialize=False, to='mailing.newsletter')),
+                ('last_customer_id', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(django_prometheus.models.ExportModelOperationsMixin('dispatch_checkpoint'), models.Model),
+        ),
+        migrations.RunSQL(
+            # keep the first message of every (newsletter, customer) pair
+            sql="""
+                DELETE FROM mailing_message AS m
+                USING mailing_message AS first
+                WHERE m.newsletter_id = first.newsletter_id
+                  AND m.customer_id = first.customer_id
+                  AND m.id > first.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(
+            sql="""
+                UPDATE mailing_newsletterstats AS s
+                SET success = c.success, ongoing = c.ongoing, failure = c.failure,
+                    canceled = c.canceled, dead = c.dead
+                FROM (
+                    SELECT n.id AS newsletter_id,
+                           count(m.id) FILTER (WHERE m.status = 'success') AS success,
+                           count(m.id) FILTER (WHERE m.status = 'ongoing') AS ongoing,
+                           count(m.id) FILTER (WHERE m.status = 'failure') AS failure,
+                           count(m.id) FILTER (WHERE m.status = 'canceled') AS canceled,
+                           count(m.id) FILTER (WHERE m.status = 'dead') AS dead
+                    FROM mailing_newsletter AS n
+                    LEFT JOIN mailing_message AS m ON m.newsletter_id = n.id
+                    GROUP BY n.id
+                ) AS c
+                WHERE s.newsletter_id = c.newsletter_id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('newsletter', 'customer'), name='message_newsletter_customer_uniq'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0006_resumable_dispatch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='delivery_window_end',
+            field=models.TimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='newsletter',
+            name='delivery_window_start',
+            field=models.TimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0007_delivery_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='dispatched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='newsletter',
+            index=models.Index(condition=models.Q(('dispatched_at__isnull', True)), fields=['start'], name='newsletter_due_idx'),
+        ),
+        migrations.RunSQL(
+            # newsletters that have already started were sent by their beat task
+            sql='UPDATE mailing_newsletter SET dispatched_at = start WHERE start <= now()',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,193 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:20
+
+import django.db.models.deletion
+import django.utils.timezone
+import django_prometheus.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0008_due_newsletter_poller'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('newsletter', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='message_archive', serialize=False, to='mailing.newsletter')),
+                ('success', models.IntegerField(default=0)),
+                ('ongoing', models.IntegerField(default=0)),
+                ('failure', models.IntegerField(default=0)),
+                ('canceled', models.IntegerField(default=0)),
+                ('dead', models.IntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(django_prometheus.models.ExportModelOperationsMixin('message_archive'), models.Model),
+        ),
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='message_newsletter_customer_uniq',
+        ),
+        # mailing_message becomes a table partitioned by month of created_at:
+        # the existing table is attached as the partition of everything
+        # before the current month, the messages of the current month are
+        # moved to its own partition. Later partitions are created by the
+        # create_message_partitions task, rows out of them go to the default
+        # partition. The primary key has to include created_at, the identity
+        # of the id column is replaced by a sequence. Foreign keys and their
+        # indexes are looked up in the catalog and recreated on the
+        # partitioned table under the same names.
+        migrations.RunSQL(
+            sql="""
+                DO $$
+                DECLARE
+                    current_month timestamptz := date_trunc('month', now(), 'UTC');
+                    month timestamptz;
+                    item record;
+                    foreign_keys text[] := '{}';
+                    indexes text[] := '{}';
+                    statement text;
+                BEGIN
+                    ALTER TABLE mailing_message RENAME TO mailing_message_legacy;
+                    ALTER TABLE mailing_message_legacy ALTER COLUMN id DROP IDENTITY;
+
+                    FOR item IN
+                        SELECT conname, contype, pg_get_constraintdef(oid) AS definition FROM pg_constraint
+                        WHERE conrelid = 'mailing_message_legacy'::regclass AND contype IN ('p', 'f')
+                    LOOP
+                        EXECUTE format('ALTER TABLE mailing_message_legacy DROP CONSTRAINT %I', item.conname);
+                        IF item.contype = 'f' THEN
+                            foreign_keys := foreign_keys || format('ADD CONSTRAINT %I %s', item.conname, item.definition);
+                        END IF;
+                    END LOOP;
+                    -- the indexes left are the ones of the foreign keys, they
+                    -- are kept on the legacy partition under another name
+                    FOR item IN
+                        SELECT c.relname, (
+                            SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY k.position)
+                            FROM unnest(i.indkey) WITH ORDINALITY AS k (attnum, position)
+                            JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                        ) AS columns
+                        FROM pg_index AS i JOIN pg_class AS c ON c.oid = i.indexrelid
+                        WHERE i.indrelid = 'mailing_message_legacy'::regclass
+                    LOOP
+                        EXECUTE format(
+                            'ALTER INDEX %I RENAME TO %I',
+                            item.relname,
+                            left(replace(item.relname, 'mailing_message_', 'mailing_message_legacy_'), 63)
+                        );
+                        indexes := indexes || format('CREATE INDEX %I ON mailing_message (%s)', item.relname, item.columns);
+                    END LOOP;
+
+                    CREATE TABLE mailing_message (
+                        LIKE mailing_message_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+                    ) PARTITION BY RANGE (created_at);
+                    CREATE SEQUENCE mailing_message_id_seq OWNED BY mailing_message.id;
+                    PERFORM setval('mailing_message_id_seq', coalesce(max(id), 0) + 1, false)
+                        FROM mailing_message_legacy;
+                    ALTER TABLE mailing_message
+                        ALTER COLUMN id SET DEFAULT nextval('mailing_message_id_seq'),
+                        ADD CONSTRAINT mailing_message_pkey PRIMARY KEY (id, created_at);
+
+                    FOR month IN
+                        SELECT generate_series(current_month, current_month + interval '1 month', interval '1 month')
+                    LOOP
+                        EXECUTE format(
+                            'CREATE TABLE %I PARTITION OF mailing_message FOR VALUES FROM (%L) TO (%L)',
+                            'mailing_message_p' || to_char(month AT TIME ZONE 'UTC', 'YYYY_MM'),
+                            month,
+                            month + interval '1 month'
+                        );
+                    END LOOP;
+
+                    INSERT INTO mailing_message
+                        SELECT * FROM mailing_message_legacy WHERE created_at >= current_month;
+                    DELETE FROM mailing_message_legacy WHERE created_at >= current_month;
+                    EXECUTE format(
+                        'ALTER TABLE mailing_message ATTACH PARTITION mailing_message_legacy '
+                        'FOR VALUES FROM (MINVALUE) TO (%L)',
+                        current_month
+                    );
+                    CREATE TABLE mailing_message_default PARTITION OF mailing_message DEFAULT;
+
+                    FOREACH statement IN ARRAY foreign_keys LOOP
+                        EXECUTE 'ALTER TABLE mailing_message ' || statement;
+                    END LOOP;
+                    -- the renamed indexes of the legacy partition are attached
+                    -- to the new ones instead of being built again
+                    FOREACH statement IN ARRAY indexes LOOP
+                        EXECUTE statement;
+                    END LOOP;
+                END $$;
+            """,
+            # back to a plain table holding the rows of every partition still
+            # attached, the archived ones are only left as MessageArchive
+            # counters which are dropped as well
+            reverse_sql="""
+                DO $$
+                DECLARE
+                    item record;
+                    foreign_keys text[] := '{}';
+                    indexes text[] := '{}';
+                    statement text;
+                BEGIN
+                    ALTER TABLE mailing_message RENAME TO mailing_message_partitioned;
+
+                    FOR item IN
+                        SELECT conname, pg_get_constraintdef(oid) AS definition FROM pg_constraint
+                        WHERE conrelid = 'mailing_message_partitioned'::regclass AND contype = 'f'
+                    LOOP
+                        foreign_keys := foreign_keys || format('ADD CONSTRAINT %I %s', item.conname, item.definition);
+                    END LOOP;
+                    FOR item IN
+                        SELECT c.relname, (
+                            SELECT string_agg(quote_ident(a.attname), ', ' ORDER BY k.position)
+                            FROM unnest(i.indkey) WITH ORDINALITY AS k (attnum, position)
+                            JOIN pg_attribute AS a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                        ) AS columns
+                        FROM pg_index AS i JOIN pg_class AS c ON c.oid = i.indexrelid
+                        WHERE i.indrelid = 'mailing_message_partitioned'::regclass AND NOT i.indisprimary
+                    LOOP
+                        indexes := indexes || format('CREATE INDEX %I ON mailing_message (%s)', item.relname, item.columns);
+                    END LOOP;
+
+                    CREATE TABLE mailing_message (
+                        LIKE mailing_message_partitioned INCLUDING CONSTRAINTS
+                    );
+                    INSERT INTO mailing_message SELECT * FROM mailing_message_partitioned;
+                    -- drops the partitions and the id sequence along
+                    DROP TABLE mailing_message_partitioned;
+
+                    ALTER TABLE mailing_message
+                        ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY,
+                        ADD CONSTRAINT mailing_message_pkey PRIMARY KEY (id);
+                    PERFORM setval(pg_get_serial_sequence('mailing_message', 'id'), coalesce(max(id), 0) + 1, false)
+                        FROM mailing_message;
+                    FOREACH statement IN ARRAY foreign_keys LOOP
+                        EXECUTE 'ALTER TABLE mailing_message ' || statement;
+                    END LOOP;
+                    FOREACH statement IN ARRAY indexes LOOP
+                        EXECUTE statement;
+                    END LOOP;
+                END $$;
+            """,
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['newsletter', 'customer'], name='message_recipient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(
+                condition=models.Q(('attempts', 0), ('status', 'ongoing')),
+                fields=['newsletter', 'customer'],
+                name='message_pending_idx',
+            ),
+        ),
+    ]
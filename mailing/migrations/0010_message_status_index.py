@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-17 00:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0009_message_partitioning'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['status', 'newsletter'], name='message_status_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-17 01:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0010_message_status_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_recipient_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('newsletter', 'customer', 'created_at'), name='message_recipient_uniq'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.5 on 2026-10-17 01:40
+
+import string
+
+from django.db import migrations
+from django.db.models import Q
+
+# the template grammar as of this migration, frozen so that later changes
+# to mailing.message_template don't change what it escapes
+PLACEHOLDERS = ('phone_number', 'mobile_operator_code', 'tag', 'local_time', 'local_date')
+
+
+def is_valid_template(text):
+    try:
+        parsed = list(string.Formatter().parse(text))
+    except ValueError:
+        return False
+    return all(
+        placeholder is None or (placeholder in PLACEHOLDERS and not format_spec and not conversion)
+        for _, placeholder, format_spec, conversion in parsed
+    )
+
+
+def escape_message_texts(apps, schema_editor):
+    # texts saved before templates were validated were sent as they are,
+    # the braces of the ones that don't parse as a template are escaped
+    # so they keep being sent the same way and can be saved again
+    Newsletter = apps.get_model('mailing', 'Newsletter')
+    newsletters = (
+        Newsletter.objects
+        .filter(Q(message_text__contains='{') | Q(message_text__contains='}'))
+        .only('id', 'message_text')
+    )
+    escaped = []
+    for newsletter in newsletters.iterator():
+        if not is_valid_template(newsletter.message_text):
+            newsletter.message_text = newsletter.message_text.replace('{', '{{').replace('}', '}}')
+            escaped.append(newsletter)
+    Newsletter.objects.bulk_update(escaped, ['message_text'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailing', '0011_message_recipient_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(escape_message_texts, migrations.RunPython.noop),
+    ]
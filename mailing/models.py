@@ -1,8 +1,12 @@
 import datetime
 import json
 
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.db import connection, models, transaction
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
 from django.utils import timezone
 from django_celery_beat.models import ClockedSchedule, PeriodicTask
 from django_prometheus.models import ExportModelOperationsMixin
@@ -10,6 +14,71 @@ from timezone_field import TimeZoneField
 
 from core import models as core_models
 
+from . import response_cache
+
+RESEGMENT_TABLE = 'mailing_customer_resegment'
+
+
+class CustomerQuerySet(models.QuerySet):
+
+    def resegment(self, **fields) -> int:
+        """
+        Update the segment fields (mobile_operator_code, tag) of the whole
+        customer set and resync its newsletters membership, unlike update()
+        which bypasses the sync done by Customer.save().
+        """
+        customer_ids, params = self.values('id').query.sql_with_params()
+        with transaction.atomic(), connection.cursor() as cursor:
+            # the set is pinned in a temporary table, the update may change
+            # what it filters on
+            cursor.execute(f'CREATE TEMPORARY TABLE {RESEGMENT_TABLE} AS {customer_ids}', params)
+            customers = self.model.objects.filter(id__in=RawSQL(f'SELECT id FROM {RESEGMENT_TABLE}', []))
+            updated = customers.update(**fields, updated_at=timezone.now())
+            customers.sync_newsletters()
+            cursor.execute(f'DROP TABLE {RESEGMENT_TABLE}')
+            response_cache.invalidate_all('customer')
+        return updated
+
+    def delete(self):
+        with transaction.atomic():
+            # the cascade deletes messages without going through Message
+            NewsletterStats.objects.subtract_customers(self)
+            deleted = super().delete()
+            response_cache.invalidate_all('customer')
+        return deleted
+
+    def sync_newsletters(self) -> None:
+        """
+        Recompute active newsletters membership of the whole customer set
+        with two set-based statements instead of a per-customer resync.
+        """
+        customers_table = self.model._meta.db_table
+        newsletters_table = Newsletter._meta.db_table
+        through_table = Newsletter.customers.through._meta.db_table
+        customer_ids, params = self.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            # remove customers from newsletters they don't match anymore
+            cursor.execute(
+                f'DELETE FROM {through_table} AS nc '
+                f'USING {customers_table} AS c, {newsletters_table} AS n '
+                f'WHERE nc.customer_id = c.id AND nc.newsletter_id = n.id '
+                f'AND c.id IN ({customer_ids}) AND n.finish > %s '
+                f'AND NOT (n.mobile_operator_codes @> ARRAY[c.mobile_operator_code]::varchar[] '
+                f'AND n.tags @> ARRAY[c.tag]::varchar[])',
+                [*params, timezone.now()],
+            )
+            # add customers to newsletters that matched the filter
+            cursor.execute(
+                f'INSERT INTO {through_table} (newsletter_id, customer_id) '
+                f'SELECT n.id, c.id FROM {customers_table} AS c '
+                f'JOIN {newsletters_table} AS n '
+                f'ON n.mobile_operator_codes @> ARRAY[c.mobile_operator_code]::varchar[] '
+                f'AND n.tags @> ARRAY[c.tag]::varchar[] '
+                f'WHERE c.id IN ({customer_ids}) AND n.finish > %s AND NOT n.dynamic_audience '
+                f'ON CONFLICT (newsletter_id, customer_id) DO NOTHING',
+                [*params, timezone.now()],
+            )
+
 
 class Customer(ExportModelOperationsMixin('customer'), core_models.TimeTrackable):
     phone_number = models.CharField(max_length=11, unique=True)
@@ -17,9 +86,16 @@ class Customer(ExportModelOperationsMixin('customer'), core_models.TimeTrackable
     tag = models.CharField(max_length=30)
     timezone = TimeZoneField(default='Europe/Moscow')
 
+    objects = CustomerQuerySet.as_manager()
+
     __original_mobile_operator_code: str
     __original_tag: str
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['mobile_operator_code', 'tag'], name='customer_segment_idx'),
+        ]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__original_mobile_operator_code = self.mobile_operator_code
@@ -45,9 +121,20 @@ class Customer(ExportModelOperationsMixin('customer'), core_models.TimeTrackable
 
         self.__original_mobile_operator_code = self.mobile_operator_code
         self.__original_tag = self.tag
+        response_cache.invalidate('customer', self.id)
+
+    def delete(self, *args, **kwargs):
+        response_cache.invalidate('customer', self.id)
+        with transaction.atomic():
+            # the cascade deletes messages without going through Message
+            NewsletterStats.objects.subtract_customers(Customer.objects.filter(id=self.id))
+            return super().delete(*args, **kwargs)
 
     def _add_to_newsletter(self):
+        # finished newsletters are never sent again, so they aren't scanned
         newsletters = Newsletter.objects.filter(
+            dynamic_audience=False,
+            finish__gt=timezone.now(),
             mobile_operator_codes__contains=[self.mobile_operator_code],
             tags__contains=[self.tag],
         )
@@ -56,6 +143,7 @@ class Customer(ExportModelOperationsMixin('customer'), core_models.TimeTrackable
 
     def _remove_from_newsletter(self):
         newsletters = self.newsletters.filter(
+            finish__gt=timezone.now(),
             mobile_operator_codes__contains=[
                 self.__original_mobile_operator_code],
             tags__contains=[self.__original_tag],
@@ -70,6 +158,16 @@ class Customer(ExportModelOperationsMixin('customer'), core_models.TimeTrackable
                 f'| tag: {self.tag}')
 
 
+class NewsletterQuerySet(models.QuerySet):
+
+    def delete(self):
+        # bulk deletes, e.g. the admin action, skip Newsletter.delete()
+        with transaction.atomic():
+            deleted = super().delete()
+            response_cache.invalidate_all('newsletter')
+        return deleted
+
+
 class Newsletter(ExportModelOperationsMixin('newsletter'), core_models.TimeTrackable):
     start = models.DateTimeField()
     finish = models.DateTimeField()
@@ -77,40 +175,120 @@ class Newsletter(ExportModelOperationsMixin('newsletter'), core_models.TimeTrack
     mobile_operator_codes = ArrayField(models.CharField(max_length=3))
     tags = ArrayField(models.CharField(max_length=30))
     customers = models.ManyToManyField(Customer, related_name='newsletters')
+    # resolve the audience from the filter at send time instead of
+    # keeping the customers m2m in sync
+    dynamic_audience = models.BooleanField(default=False)
+    # deliver only between these recipient-local times, may wrap midnight
+    delivery_window_start = models.TimeField(null=True, blank=True)
+    delivery_window_end = models.TimeField(null=True, blank=True)
+    # set once the newsletter has been handed over to send_newsletter
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+
+    objects = NewsletterQuerySet.as_manager()
 
     __original_start: datetime.datetime
     __original_finish: datetime.datetime
+    __original_mobile_operator_codes: list[str]
+    __original_tags: list[str]
+    __original_dynamic_audience: bool
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['mobile_operator_codes'], name='newsletter_operator_codes_idx'),
+            GinIndex(fields=['tags'], name='newsletter_tags_idx'),
+            models.Index(fields=['finish'], name='newsletter_finish_idx'),
+            # newsletters waiting for dispatch_due_newsletters
+            models.Index(fields=['start'], condition=Q(dispatched_at__isnull=True), name='newsletter_due_idx'),
+        ]
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.__original_start = self.start
         self.__original_finish = self.finish
+        self.__original_mobile_operator_codes = list(self.mobile_operator_codes or [])
+        self.__original_tags = list(self.tags or [])
+        self.__original_dynamic_audience = self.dynamic_audience
 
     def save(self, *args, **kwargs):
 
         is_new = self._state.adding
+        if not is_new and self.start != self.__original_start:
+            # dispatch the newsletter again at the new start
+            self.dispatched_at = None
         super().save(*args, **kwargs)
+        if is_new:
+            NewsletterStats.objects.create(newsletter=self)
 
-        # add customers that matched the filter
-        customers = Customer.objects.filter(
-            mobile_operator_code__in=self.mobile_operator_codes,
-            tag__in=self.tags,
-        )
-        self.customers.add(*customers)
-        if is_new and timezone.now() < self.finish:
-            # create a task to run once at self.start
-            self._create_task()
+        if self.dynamic_audience:
+            if not is_new and not self.__original_dynamic_audience:
+                # the audience is resolved at send time from now on
+                self.customers.clear()
+        elif is_new or self.__original_dynamic_audience:
+            # add customers that matched the filter
+            self._add_customers()
         elif (
-                self.start != self.__original_start
-                or self.finish != self.__original_finish
+                self.mobile_operator_codes != self.__original_mobile_operator_codes
+                or self.tags != self.__original_tags
         ):
-            # delete old and create a new task if start has been changed
-            if hasattr(self, 'task'):
-                self._delete_task()
-            self._create_task()
+            # replace customers if the filter has been changed
+            self._remove_customers()
+            self._add_customers()
+
+        # in the poller mode due newsletters are picked up by
+        # dispatch_due_newsletters instead of a task of their own
+        if settings.MAILING_SCHEDULER == 'beat':
+            if is_new and timezone.now() < self.finish:
+                # create a task to run once at self.start
+                self._create_task()
+            elif (
+                    self.start != self.__original_start
+                    or self.finish != self.__original_finish
+            ):
+                # delete old and create a new task if start has been changed
+                if hasattr(self, 'task'):
+                    self._delete_task()
+                self._create_task()
 
         self.__original_start = self.start
         self.__original_finish = self.finish
+        self.__original_mobile_operator_codes = list(self.mobile_operator_codes)
+        self.__original_tags = list(self.tags)
+        self.__original_dynamic_audience = self.dynamic_audience
+        response_cache.invalidate('newsletter', self.id)
+
+    def delete(self, *args, **kwargs):
+        response_cache.invalidate('newsletter', self.id)
+        return super().delete(*args, **kwargs)
+
+    def get_audience(self) -> models.QuerySet[Customer]:
+        if self.dynamic_audience:
+            return Customer.objects.filter(
+                mobile_operator_code__in=self.mobile_operator_codes,
+                tag__in=self.tags,
+            )
+        return self.customers.all()
+
+    def _add_customers(self):
+        # materialize the audience inside the database instead of loading
+        # every matching customer into memory
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.customers.through._meta.db_table} (newsletter_id, customer_id) '
+                f'SELECT %s, id FROM {Customer._meta.db_table} '
+                f'WHERE mobile_operator_code = ANY(%s::varchar[]) AND tag = ANY(%s::varchar[]) '
+                f'ON CONFLICT (newsletter_id, customer_id) DO NOTHING',
+                [self.id, self.mobile_operator_codes, self.tags],
+            )
+
+    def _remove_customers(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.customers.through._meta.db_table} AS nc '
+                f'USING {Customer._meta.db_table} AS c '
+                f'WHERE nc.newsletter_id = %s AND nc.customer_id = c.id '
+                f'AND NOT (c.mobile_operator_code = ANY(%s::varchar[]) AND c.tag = ANY(%s::varchar[]))',
+                [self.id, self.mobile_operator_codes, self.tags],
+            )
 
     def _create_task(self):
         clocked, _ = ClockedSchedule.objects.get_or_create(clocked_time=self.start)
@@ -128,10 +306,15 @@ class Newsletter(ExportModelOperationsMixin('newsletter'), core_models.TimeTrack
         self.task.delete()
 
     def __str__(self):
-        return (f'id: {self.id} '
-                f'| start: {self.start} '
-                f'| finish: {self.finish} '
-                f'| messages: {self.messages.count()}')
+        description = (f'id: {self.id} '
+                       f'| start: {self.start} '
+                       f'| finish: {self.finish}')
+        # the counters are shown only when loaded along, e.g. by
+        # select_related('stats'), not to cost a query per newsletter
+        stats = Newsletter.stats.related.get_cached_value(self, default=None)
+        if stats is None:
+            return description
+        return f'{description} | messages: {stats.total}'
 
 
 class Message(ExportModelOperationsMixin('message'), core_models.TimeTrackable):
@@ -140,10 +323,53 @@ class Message(ExportModelOperationsMixin('message'), core_models.TimeTrackable):
         ONGOING = 'ongoing'
         FAILURE = 'failure'
         CANCELED = 'canceled'
+        # failed after MAILING_RETRY_MAX_ATTEMPTS attempts
+        DEAD = 'dead'
 
     status = models.CharField(max_length=10, choices=Status.choices, default=Status.ONGOING)
     newsletter = models.ForeignKey(Newsletter, on_delete=models.CASCADE, related_name='messages')
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='messages')
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    __original_status: str
+
+    class Meta:
+        # the table is partitioned by created_at, see mailing.partitions, so
+        # a unique constraint has to include it. It only catches a message
+        # inserted twice at once, send_messages keeps (newsletter, customer)
+        # unique across partitions
+        constraints = [
+            models.UniqueConstraint(
+                fields=['newsletter', 'customer', 'created_at'], name='message_recipient_uniq',
+            ),
+        ]
+        indexes = [
+            # messages never sent yet, looked up for every chunk of a dispatch
+            models.Index(
+                fields=['newsletter', 'customer'],
+                condition=Q(status='ongoing', attempts=0),
+                name='message_pending_idx',
+            ),
+            models.Index(fields=['status', 'newsletter'], name='message_status_idx'),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__original_status = self.status
+
+    def save(self, *args, **kwargs):
+
+        is_new = self._state.adding
+        super().save(*args, **kwargs)
+        if is_new:
+            NewsletterStats.objects.add(self.newsletter_id, {self.status: 1})
+        elif self.status != self.__original_status:
+            NewsletterStats.objects.add(
+                self.newsletter_id,
+                {self.__original_status: -1, self.status: 1},
+            )
+
+        self.__original_status = self.status
 
     def __str__(self):
         return (f'id: {self.id} '
@@ -152,5 +378,137 @@ class Message(ExportModelOperationsMixin('message'), core_models.TimeTrackable):
                 f'| status: {self.status}')
 
 
+class NewsletterStatsQuerySet(models.QuerySet):
+
+    def add(self, newsletter_id: int, deltas: dict[str, int]) -> None:
+        # deltas are keyed by Message.Status
+        self.filter(newsletter_id=newsletter_id).update(**{
+            message_status: F(message_status) + delta
+            for message_status, delta in deltas.items()
+        })
+
+    def subtract_customers(self, customers: models.QuerySet[Customer]) -> None:
+        """
+        Subtract the messages of customers about to be deleted from the
+        counters of their newsletters.
+        """
+        counters = ', '.join(
+            f'{counter} = s.{counter} - d.{counter}' for counter in Message.Status.values
+        )
+        counts = ', '.join(
+            f'count(*) FILTER (WHERE status = %s) AS {counter}' for counter in Message.Status.values
+        )
+        customer_ids, params = customers.values('id').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {self.model._meta.db_table} AS s SET {counters} '
+                f'FROM (SELECT newsletter_id, {counts} FROM {Message._meta.db_table} '
+                f'WHERE customer_id IN ({customer_ids}) GROUP BY newsletter_id) AS d '
+                f'WHERE s.newsletter_id = d.newsletter_id',
+                [*Message.Status.values, *params],
+            )
+
+    def reconcile(self, newsletter_ids: list[int] | None = None) -> None:
+        """
+        Recompute counters from the messages table and the archived
+        messages summary, creating the missing ones.
+        """
+        counters = ', '.join(Message.Status.values)
+        counts = ', '.join(
+            f'count(m.id) FILTER (WHERE m.status = %s) + coalesce(a.{counter}, 0)'
+            for counter in Message.Status.values
+        )
+        excluded = ', '.join(f'{counter} = EXCLUDED.{counter}' for counter in Message.Status.values)
+        where = 'WHERE n.id = ANY(%s)' if newsletter_ids is not None else ''
+        params = [*Message.Status.values, *([newsletter_ids] if newsletter_ids is not None else [])]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.model._meta.db_table} (newsletter_id, {counters}) '
+                f'SELECT n.id, {counts} '
+                f'FROM {Newsletter._meta.db_table} AS n '
+                f'LEFT JOIN {Message._meta.db_table} AS m ON m.newsletter_id = n.id '
+                f'LEFT JOIN {MessageArchive._meta.db_table} AS a ON a.newsletter_id = n.id '
+                f'{where} GROUP BY n.id, a.newsletter_id '
+                f'ON CONFLICT (newsletter_id) DO UPDATE SET {excluded}',
+                params,
+            )
+
+
+class NewsletterStats(ExportModelOperationsMixin('newsletter_stats'), models.Model):
+    """
+    Per-newsletter message counters, one per Message.Status, maintained
+    incrementally by the dispatch path.
+    """
+    newsletter = models.OneToOneField(
+        Newsletter,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+    )
+    success = models.IntegerField(default=0)
+    ongoing = models.IntegerField(default=0)
+    failure = models.IntegerField(default=0)
+    canceled = models.IntegerField(default=0)
+    dead = models.IntegerField(default=0)
+
+    objects = NewsletterStatsQuerySet.as_manager()
+
+    @property
+    def total(self) -> int:
+        return sum(getattr(self, message_status) for message_status in Message.Status.values)
+
+    def __str__(self):
+        return (f'newsletter_id: {self.newsletter_id} '
+                f'| success: {self.success} '
+                f'| ongoing: {self.ongoing} '
+                f'| failure: {self.failure} '
+                f'| canceled: {self.canceled} '
+                f'| dead: {self.dead}')
+
+
+class MessageArchive(ExportModelOperationsMixin('message_archive'), core_models.TimeTrackable):
+    """
+    Per-newsletter counters of the messages whose partitions have been
+    dropped by the archive_messages command.
+    """
+    newsletter = models.OneToOneField(
+        Newsletter,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='message_archive',
+    )
+    success = models.IntegerField(default=0)
+    ongoing = models.IntegerField(default=0)
+    failure = models.IntegerField(default=0)
+    canceled = models.IntegerField(default=0)
+    dead = models.IntegerField(default=0)
+
+    def __str__(self):
+        return (f'newsletter_id: {self.newsletter_id} '
+                f'| success: {self.success} '
+                f'| ongoing: {self.ongoing} '
+                f'| failure: {self.failure} '
+                f'| canceled: {self.canceled} '
+                f'| dead: {self.dead}')
+
+
+class DispatchCheckpoint(ExportModelOperationsMixin('dispatch_checkpoint'), core_models.TimeTrackable):
+    """
+    Progress of a newsletter dispatch: recipients are dispatched in
+    customer id order and everything up to last_customer_id is done.
+    """
+    newsletter = models.OneToOneField(
+        Newsletter,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='checkpoint',
+    )
+    last_customer_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return (f'newsletter_id: {self.newsletter_id} '
+                f'| last_customer_id: {self.last_customer_id}')
+
+
 class MailingTask(ExportModelOperationsMixin('mailing_task'), PeriodicTask):
     newsletter = models.OneToOneField(Newsletter, on_delete=models.CASCADE, related_name='task')
@@ -0,0 +1,101 @@
+import datetime
+import re
+from typing import NamedTuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, MessageArchive
+
+# upper bound of a range partition as printed by pg_get_expr
+PARTITION_UPPER_BOUND_PATTERN = re.compile(r"TO \('([^']+)'\)")
+
+
+class MessagePartition(NamedTuple):
+    name: str
+    # None for the default partition
+    upper_bound: datetime.datetime | None
+
+
+def get_month_start(value: datetime.datetime, months: int = 0) -> datetime.datetime:
+    # first moment of the month `months` months after the one of value, in UTC
+    value = value.astimezone(datetime.timezone.utc)
+    month_index = value.month - 1 + months
+    return datetime.datetime(
+        value.year + month_index // 12, month_index % 12 + 1, 1, tzinfo=datetime.timezone.utc,
+    )
+
+
+def create_message_partitions(months_ahead: int | None = None) -> list[str]:
+    """
+    Create the monthly partitions of messages from the current month up to
+    `months_ahead` months ahead, returns the names of the created ones.
+    """
+    if months_ahead is None:
+        months_ahead = settings.MAILING_MESSAGE_PARTITIONS_AHEAD
+    existing = {partition.name for partition in get_message_partitions()}
+    created = []
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        for months in range(months_ahead + 1):
+            month_start = get_month_start(now, months)
+            name = f'{Message._meta.db_table}_p{month_start:%Y_%m}'
+            if name in existing:
+                continue
+            # rows of the month already in the default partition would have
+            # to be moved first, partitions are created ahead to avoid it
+            cursor.execute(
+                f'CREATE TABLE {name} PARTITION OF {Message._meta.db_table} '
+                f'FOR VALUES FROM (%s) TO (%s)',
+                [month_start, get_month_start(month_start, 1)],
+            )
+            created.append(name)
+    return created
+
+
+def get_message_partitions() -> list[MessagePartition]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) '
+            'FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid '
+            'WHERE i.inhparent = %s::regclass ORDER BY c.relname',
+            [Message._meta.db_table],
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, bound in rows:
+        match = PARTITION_UPPER_BOUND_PATTERN.search(bound)
+        partitions.append(MessagePartition(name, parse_datetime(match.group(1)) if match else None))
+    return partitions
+
+
+def archive_message_partitions(before: datetime.datetime, drop: bool = True) -> list[str]:
+    """
+    Compact the partitions holding only messages created before `before`
+    into per-newsletter MessageArchive counters and detach them, dropped
+    unless `drop` is False. Returns the names of the archived partitions.
+    """
+    counters = ', '.join(Message.Status.values)
+    counts = ', '.join('count(*) FILTER (WHERE status = %s)' for _ in Message.Status.values)
+    added = ', '.join(f'{counter} = a.{counter} + EXCLUDED.{counter}' for counter in Message.Status.values)
+    archived = []
+    for partition in get_message_partitions():
+        if partition.upper_bound is None or partition.upper_bound > before:
+            continue
+        with transaction.atomic(), connection.cursor() as cursor:
+            # a partition can't be dropped with deferred foreign key checks pending
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(
+                f'INSERT INTO {MessageArchive._meta.db_table} AS a '
+                f'(newsletter_id, created_at, updated_at, {counters}) '
+                f'SELECT newsletter_id, %s, %s, {counts} FROM {partition.name} GROUP BY newsletter_id '
+                f'ON CONFLICT (newsletter_id) DO UPDATE SET updated_at = EXCLUDED.updated_at, {added}',
+                [timezone.now(), timezone.now(), *Message.Status.values],
+            )
+            cursor.execute(f'ALTER TABLE {Message._meta.db_table} DETACH PARTITION {partition.name}')
+            if drop:
+                cursor.execute(f'DROP TABLE {partition.name}')
+        archived.append(partition.name)
+    return archived
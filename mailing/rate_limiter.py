@@ -0,0 +1,94 @@
+import functools
+import time
+
+import redis
+from django.conf import settings
+
+# Refills the bucket according to the time passed since the previous call
+# and takes a token from it. Returns 0 if a token has been taken, otherwise
+# the number of milliseconds to wait. The time is taken from redis, so the
+# bucket is consistent across all celery workers.
+TOKEN_BUCKET_SCRIPT = """
+local blocked = redis.call('PTTL', KEYS[2])
+if blocked > 0 then
+    return blocked
+end
+
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1]) or capacity
+local timestamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - timestamp) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return wait
+"""
+
+
+class TokenBucketRateLimiter:
+    """
+    Token bucket shared by every process through redis: `rate` tokens per
+    second with bursts of up to `capacity` tokens.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._bucket_key = f'mailing:rate_limit:{name}'
+        self._blocked_key = f'mailing:rate_limit:{name}:blocked'
+
+    def acquire(self) -> None:
+        # block until a token has been taken
+        while wait := _get_token_bucket_script()(
+                keys=[self._bucket_key, self._blocked_key],
+                args=[self.rate, self.capacity],
+        ):
+            time.sleep(wait / 1000)
+
+    def block(self, seconds: float) -> None:
+        # pause the bucket for every worker, e.g. after a 429 Retry-After
+        _get_redis().set(self._blocked_key, 1, px=max(int(seconds * 1000), 1))
+
+
+def get_rate_limiter(gateway: type, mobile_operator_code: str) -> TokenBucketRateLimiter | None:
+    """
+    Look up the limiter for a gateway and mobile operator code in
+    MAILING_RATE_LIMITS. Subclasses of a configured gateway share its limits.
+    """
+    for gateway_class in gateway.__mro__:
+        limits = settings.MAILING_RATE_LIMITS.get(gateway_class.__name__)
+        if limits:
+            break
+    else:
+        return None
+
+    key = mobile_operator_code if mobile_operator_code in limits else 'default'
+    if key not in limits:
+        return None
+    return _get_rate_limiter(f'{gateway_class.__name__}:{key}', limits[key])
+
+
+@functools.cache
+def _get_rate_limiter(name: str, rate: float) -> TokenBucketRateLimiter:
+    return TokenBucketRateLimiter(name, rate)
+
+
+@functools.cache
+def _get_redis() -> redis.Redis:
+    return redis.Redis.from_url(settings.REDIS_URL)
+
+
+@functools.cache
+def _get_token_bucket_script():
+    return _get_redis().register_script(TOKEN_BUCKET_SCRIPT)
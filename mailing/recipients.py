@@ -0,0 +1,46 @@
+import itertools
+import zoneinfo
+from collections.abc import Iterator
+from typing import NamedTuple
+
+from django.db import models
+
+from .models import Customer
+
+
+class Recipient(NamedTuple):
+    id: int
+    phone_number: str
+    mobile_operator_code: str
+    # rendered into message templates
+    tag: str
+    timezone: zoneinfo.ZoneInfo
+
+
+RECIPIENT_FIELDS = Recipient._fields
+
+
+def iter_recipient_chunks(
+        customers: models.QuerySet[Customer],
+        chunk_size: int,
+) -> Iterator[list[Recipient]]:
+    """
+    Stream recipients in customer id order through a named server-side
+    cursor, holding only one chunk of slim tuples in memory whatever the
+    audience size is.
+    """
+    rows = (
+        customers
+        .order_by('id')
+        .values_list(*RECIPIENT_FIELDS)
+        .iterator(chunk_size=chunk_size)
+    )
+    while chunk := [Recipient(*row) for row in itertools.islice(rows, chunk_size)]:
+        yield chunk
+
+
+def get_recipients(customer_ids: list[int]) -> list[Recipient]:
+    return [
+        Recipient(*row)
+        for row in Customer.objects.filter(id__in=customer_ids).order_by('id').values_list(*RECIPIENT_FIELDS)
+    ]
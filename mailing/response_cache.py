@@ -0,0 +1,118 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from redis import RedisError
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'mailing:response'
+
+
+def _get_key(name: str, pk: int) -> str:
+    return f'{KEY_PREFIX}:{name}:{pk}'
+
+
+def _get_version_key(name: str) -> str:
+    return f'{KEY_PREFIX}:{name}:version'
+
+
+def get_version(name: str) -> int | None:
+    # the cache is an optimization, an unavailable redis is a miss
+    try:
+        return cache.get(_get_version_key(name), 1)
+    except RedisError as e:
+        logger.warning(f'Response cache is unavailable: {e}')
+        return None
+
+
+def get_response(name: str, pk: int, version: int) -> tuple[str, dict] | None:
+    try:
+        return cache.get(_get_key(name, pk), version=version)
+    except RedisError as e:
+        logger.warning(f'Response cache is unavailable: {e}')
+        return None
+
+
+def set_response(name: str, pk: int, version: int, etag: str, data: dict) -> None:
+    try:
+        cache.set(_get_key(name, pk), (etag, data), settings.MAILING_RESPONSE_CACHE_TIMEOUT, version=version)
+    except RedisError as e:
+        logger.warning(f'Response cache is unavailable: {e}')
+
+
+def invalidate(name: str, pk: int) -> None:
+    """
+    Drop the cached response of a single object once the current
+    transaction commits, so it can't be refilled with the old row.
+    """
+    def delete():
+        try:
+            cache.delete(_get_key(name, pk), version=cache.get(_get_version_key(name), 1))
+        except RedisError as e:
+            logger.warning(f'Response cache is unavailable: {e}')
+
+    transaction.on_commit(delete)
+
+
+def invalidate_all(name: str) -> None:
+    """
+    Drop the cached responses of every object of `name` once the current
+    transaction commits by moving to the next version of their keys.
+    """
+    def bump_version():
+        try:
+            # the version never expires, the entries of the previous ones do
+            cache.add(_get_version_key(name), 1, None)
+            cache.incr(_get_version_key(name))
+        except RedisError as e:
+            logger.warning(f'Response cache is unavailable: {e}')
+
+    transaction.on_commit(bump_version)
+
+
+def get_etag(data: dict) -> str:
+    content = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+    return quote_etag(hashlib.md5(content, usedforsecurity=False).hexdigest())
+
+
+class CachedRetrieveMixin:
+    """
+    Serve retrieve from the response cache under `response_cache_name` and
+    answer If-None-Match with 304, both without touching the database.
+    The model invalidates the cache on save and delete.
+    """
+    response_cache_name: str
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            pk = int(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except ValueError:
+            return super().retrieve(request, *args, **kwargs)
+
+        # the version is read before the object, a response built from a row
+        # older than a concurrent version bump is stored under the old version
+        version = get_version(self.response_cache_name)
+        if version is None:
+            return super().retrieve(request, *args, **kwargs)
+
+        cached = get_response(self.response_cache_name, pk, version)
+        if cached is None:
+            response = super().retrieve(request, *args, **kwargs)
+            etag = get_etag(response.data)
+            set_response(self.response_cache_name, pk, version, etag, response.data)
+        else:
+            etag, data = cached
+            response = Response(data)
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
@@ -0,0 +1,50 @@
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+
+from django.conf import settings
+
+from .models import Newsletter
+from .recipients import Recipient
+
+# small newsletters, never waiting behind big campaigns
+PRIORITY_QUEUE = 'mailing.priority'
+# chunks of operators without a queue of their own
+SEND_QUEUE = 'mailing.send'
+
+
+def get_operator_queue(mobile_operator_code: str) -> str:
+    # operators listed in MAILING_OPERATOR_QUEUES get dedicated workers
+    if mobile_operator_code in settings.MAILING_OPERATOR_QUEUES:
+        return f'{SEND_QUEUE}.{mobile_operator_code}'
+    return SEND_QUEUE
+
+
+def is_priority(newsletter: Newsletter) -> bool:
+    # decided by size alone, a big campaign close to its finish would
+    # flood the priority workers. The whole audience is counted only up
+    # to the threshold
+    max_recipients = settings.MAILING_PRIORITY_MAX_RECIPIENTS
+    return newsletter.get_audience()[:max_recipients + 1].count() <= max_recipients
+
+
+def iter_queue_chunks(
+        chunks: Iterable[list[Recipient]],
+        chunk_size: int,
+) -> Iterator[tuple[str, list[Recipient]]]:
+    """
+    Regroup recipient chunks by the send queue of their mobile operator,
+    yielding (queue, recipients) chunks of up to `chunk_size` recipients
+    that keep the customer id order.
+    """
+    buffers = defaultdict(list)
+    for chunk in chunks:
+        for recipient in chunk:
+            queue = get_operator_queue(recipient.mobile_operator_code)
+            buffer = buffers[queue]
+            buffer.append(recipient)
+            if len(buffer) >= chunk_size:
+                yield queue, buffer
+                buffers[queue] = []
+    for queue, buffer in buffers.items():
+        if buffer:
+            yield queue, buffer
@@ -3,15 +3,19 @@ import re
 from rest_framework import serializers
 from timezone_field.rest_framework import TimeZoneSerializerField
 
+from .delivery_report import FILE_FORMATS as REPORT_FILE_FORMATS
+from .message_template import MessageTemplate, TemplateError
 from .models import Customer, Newsletter
 
+PHONE_NUMBER_PATTERN = re.compile(r'^7\d{10}$')
+
 
 class CustomerSerializer(serializers.ModelSerializer):
     timezone = TimeZoneSerializerField(required=False)
 
     def validate(self, data):
         phone_number = data.get('phone_number')
-        if phone_number and not re.match(r'^7\d{10}$', phone_number):
+        if phone_number and not PHONE_NUMBER_PATTERN.match(phone_number):
             raise serializers.ValidationError(
                 {
                     'phone_number': 'should be in the format 7XXXXXXXXXX',
@@ -30,8 +34,47 @@ class CustomerSerializer(serializers.ModelSerializer):
         ]
 
 
+class CustomerBulkUpdateSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+    mobile_operator_code = serializers.CharField(max_length=3, required=False)
+    tag = serializers.CharField(max_length=30, required=False)
+
+    def validate(self, data):
+        if 'mobile_operator_code' not in data and 'tag' not in data:
+            raise serializers.ValidationError('mobile_operator_code or tag must be set')
+        return data
+
+
+class CustomerImportSerializer(serializers.Serializer):
+    file = serializers.FileField()
+    file_format = serializers.ChoiceField(choices=['csv', 'jsonl'], required=False)
+
+    def validate(self, data):
+        if 'file_format' not in data:
+            extension = data['file'].name.rsplit('.', 1)[-1].lower()
+            if extension not in ('csv', 'jsonl'):
+                raise serializers.ValidationError(
+                    {
+                        'file_format': 'can\'t be detected from the file name',
+                    }
+                )
+            data['file_format'] = extension
+        return data
+
+
+class DeliveryReportSerializer(serializers.Serializer):
+    file_format = serializers.ChoiceField(choices=REPORT_FILE_FORMATS, default='csv')
+
+
 class NewsletterSerializer(serializers.ModelSerializer):
-    customers = CustomerSerializer(many=True, read_only=True)
+    # the audience is paginated by the newsletter customers action
+
+    def validate_message_text(self, value):
+        try:
+            MessageTemplate(value)
+        except TemplateError as e:
+            raise serializers.ValidationError(str(e))
+        return value
 
     def validate(self, data):
         start = data.get('start')
@@ -47,6 +90,19 @@ class NewsletterSerializer(serializers.ModelSerializer):
                     'finish': 'must occur after start',
                 }
             )
+
+        delivery_window_start = data.get('delivery_window_start')
+        delivery_window_end = data.get('delivery_window_end')
+        if self.partial:
+            delivery_window_start = data.get('delivery_window_start', self.instance.delivery_window_start)
+            delivery_window_end = data.get('delivery_window_end', self.instance.delivery_window_end)
+
+        if (delivery_window_start is None) != (delivery_window_end is None):
+            raise serializers.ValidationError(
+                {
+                    'delivery_window_end': 'must be set together with delivery_window_start',
+                }
+            )
         return data
 
     class Meta:
@@ -58,15 +114,38 @@ class NewsletterSerializer(serializers.ModelSerializer):
             'message_text',
             'mobile_operator_codes',
             'tags',
-            'customers',
+            'dynamic_audience',
+            'delivery_window_start',
+            'delivery_window_end',
+        ]
+
+
+class NewsletterListSerializer(serializers.ModelSerializer):
+    # null for a dynamic audience, it's resolved only at send time
+    customers_count = serializers.IntegerField(read_only=True, allow_null=True)
+
+    class Meta:
+        model = Newsletter
+        fields = [
+            'id',
+            'start',
+            'finish',
+            'message_text',
+            'mobile_operator_codes',
+            'tags',
+            'dynamic_audience',
+            'delivery_window_start',
+            'delivery_window_end',
+            'customers_count',
         ]
 
 
 class NewsletterStatsSerializer(serializers.ModelSerializer):
-    success = serializers.IntegerField()
-    ongoing = serializers.IntegerField()
-    failure = serializers.IntegerField()
-    canceled = serializers.IntegerField()
+    success = serializers.IntegerField(source='stats.success')
+    ongoing = serializers.IntegerField(source='stats.ongoing')
+    failure = serializers.IntegerField(source='stats.failure')
+    canceled = serializers.IntegerField(source='stats.canceled')
+    dead = serializers.IntegerField(source='stats.dead')
 
     class Meta:
         model = Newsletter
@@ -81,4 +160,5 @@ class NewsletterStatsSerializer(serializers.ModelSerializer):
             'ongoing',
             'failure',
             'canceled',
+            'dead',
         ]
@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Message, NewsletterStats
+
+
+class MessageStatusWriter:
+    """
+    Collects (message_id, status) results of send attempts and writes
+    them back with a single UPDATE ... FROM (VALUES ...) statement every
+    `flush_size` results or `flush_interval` milliseconds, whichever comes
+    first. The same statement moves the newsletter stats counters.
+
+    There is no timer, the interval is checked when a result is added, so
+    results wait for the next one while the gateway is slow and are
+    flushed at the latest when the writer is exited.
+    """
+
+    def __init__(self, flush_size: int | None = None, flush_interval: int | None = None):
+        self.flush_size = flush_size or settings.MAILING_STATUS_FLUSH_SIZE
+        self.flush_interval = flush_interval or settings.MAILING_STATUS_FLUSH_INTERVAL
+        self._statuses: dict[int, str] = {}
+        self._flushed_at = time.monotonic()
+
+    def __enter__(self) -> 'MessageStatusWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # results that are already known must not be lost even if the
+        # sending loop failed halfway
+        self.flush()
+
+    def add(self, message_id: int, status: Message.Status) -> None:
+        self._statuses[message_id] = status
+        elapsed = (time.monotonic() - self._flushed_at) * 1000
+        if len(self._statuses) >= self.flush_size or elapsed >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._statuses:
+            values = ', '.join(['(%s, %s)'] * len(self._statuses))
+            params = [item for pair in self._statuses.items() for item in pair]
+            # the self-joined `old` row still holds the status before the update
+            deltas = ', '.join(
+                f'count(*) FILTER (WHERE new_status = %s) '
+                f'- count(*) FILTER (WHERE old_status = %s) AS {message_status}'
+                for message_status in Message.Status.values
+            )
+            counters = ', '.join(
+                f'{message_status} = s.{message_status} + d.{message_status}'
+                for message_status in Message.Status.values
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'WITH updated AS ('
+                    f'UPDATE {Message._meta.db_table} AS m '
+                    f'SET status = v.status, attempts = m.attempts + 1, updated_at = %s '
+                    f'FROM (VALUES {values}) AS v (id, status), {Message._meta.db_table} AS old '
+                    f'WHERE m.id = v.id AND old.id = m.id '
+                    f'RETURNING m.newsletter_id, old.status AS old_status, m.status AS new_status'
+                    f'), deltas AS ('
+                    f'SELECT newsletter_id, {deltas} FROM updated GROUP BY newsletter_id'
+                    f') '
+                    f'UPDATE {NewsletterStats._meta.db_table} AS s SET {counters} '
+                    f'FROM deltas AS d WHERE s.newsletter_id = d.newsletter_id',
+                    [
+                        timezone.now(),
+                        *params,
+                        *(value for message_status in Message.Status.values for value in [message_status] * 2),
+                    ],
+                )
+            self._statuses = {}
+        self._flushed_at = time.monotonic()
@@ -1,9 +1,27 @@
-from celery import shared_task
+import datetime
+import functools
+import operator
+import random
+import zoneinfo
+from collections import defaultdict
+from collections.abc import Callable
+
+from celery import Task, current_app, shared_task
 from celery.utils.log import get_task_logger
+from django.conf import settings
+from django.db import connection, models, transaction
 from django.utils import timezone
+from django.utils.module_loading import import_string
 
-from .message_gateway import AbstractMessageGateway, MessageGateway
-from .models import Customer, Message, Newsletter
+from . import metrics, partitions, routing
+from .message_gateway import (AbstractMessageGateway, ConcurrentMessageGateway,
+                              OutgoingMessage)
+from .message_template import TemplateError, get_message_template
+from .models import (Customer, DispatchCheckpoint, Message, Newsletter,
+                     NewsletterStats)
+from .recipients import (RECIPIENT_FIELDS, Recipient, get_recipients,
+                         iter_recipient_chunks)
+from .status_writer import MessageStatusWriter
 
 logger = get_task_logger(__name__)
 
@@ -11,28 +29,420 @@ logger = get_task_logger(__name__)
 @shared_task
 def send_newsletter(
         newsletter_id: int,
-        gateway: AbstractMessageGateway = MessageGateway
+        gateway: AbstractMessageGateway = ConcurrentMessageGateway,
+        fan_out: bool | None = None,
+) -> None:
+    with metrics.DISPATCH_SECONDS.labels('send_newsletter').time():
+        newsletter = Newsletter.objects.get(id=newsletter_id)
+        Newsletter.objects.filter(id=newsletter_id, dispatched_at__isnull=True).update(dispatched_at=timezone.now())
+        dispatch_newsletter(newsletter, gateway, fan_out, last_customer_id=0)
+
+
+@shared_task
+def dispatch_due_newsletters() -> None:
+    # rows are claimed with SKIP LOCKED, so several pollers never
+    # dispatch the same newsletter
+    now = timezone.now()
+    with transaction.atomic():
+        due_newsletters = list(
+            Newsletter.objects
+            .select_for_update(skip_locked=True)
+            .filter(dispatched_at__isnull=True, start__lte=now)
+            .order_by('start')
+            .values_list('id', 'finish')[:settings.MAILING_POLL_BATCH_SIZE]
+        )
+        Newsletter.objects.filter(
+            id__in=[newsletter_id for newsletter_id, _ in due_newsletters],
+        ).update(dispatched_at=now)
+
+        # newsletters that finished while waiting are only marked as dispatched
+        for newsletter_id, finish in due_newsletters:
+            if finish > now:
+                transaction.on_commit(functools.partial(send_newsletter.delay, newsletter_id))
+
+
+@shared_task
+def resume_newsletter(
+        newsletter_id: int,
+        gateway: AbstractMessageGateway = ConcurrentMessageGateway,
+        fan_out: bool | None = None,
+) -> None:
+    # continue an interrupted dispatch from its last checkpoint
+    newsletter = Newsletter.objects.get(id=newsletter_id)
+    checkpoint, _ = DispatchCheckpoint.objects.get_or_create(newsletter=newsletter)
+    dispatch_newsletter(newsletter, gateway, fan_out, checkpoint.last_customer_id)
+
+
+@shared_task
+def send_newsletter_bucket(
+        newsletter_id: int,
+        timezones: list[str],
+        gateway: str = 'mailing.message_gateway.ConcurrentMessageGateway',
 ) -> None:
+    # recipients whose delivery window has just opened
     newsletter = Newsletter.objects.get(id=newsletter_id)
-    for customer in newsletter.customers.all():
-        send_message(gateway, newsletter, customer)
+    dispatch_newsletter(newsletter, import_string(gateway), None, 0, timezones)
+
+
+def dispatch_newsletter(
+        newsletter: Newsletter,
+        gateway: AbstractMessageGateway,
+        fan_out: bool | None,
+        last_customer_id: int,
+        timezones: list[str] | None = None,
+) -> None:
+    if timezones is None and newsletter.delivery_window_start is not None:
+        _schedule_delivery_windows(newsletter, gateway)
+        return
+
+    if fan_out is None:
+        fan_out = settings.MAILING_FAN_OUT
+
+    chunks = iter_recipient_chunks(
+        _get_audience(newsletter, last_customer_id, timezones),
+        settings.MAILING_CHUNK_SIZE,
+    )
+    if fan_out:
+        # every chunk is sent by its own task, so the send time
+        # scales with the number of workers. Chunks go to the queue of
+        # their mobile operator, or all to the priority queue, decided
+        # once for the whole audience, not the part of it being resumed
+        # or whose delivery window opens
+        is_priority = routing.is_priority(newsletter)
+        last_customer_id = 0
+        for queue, recipients in routing.iter_queue_chunks(chunks, settings.MAILING_CHUNK_SIZE):
+            customer_ids = [recipient.id for recipient in recipients]
+            send_newsletter_chunk.apply_async(
+                (newsletter.id, customer_ids, _get_gateway_path(gateway)),
+                queue=routing.PRIORITY_QUEUE if is_priority else queue,
+            )
+            last_customer_id = max(customer_ids[-1], last_customer_id)
+        if last_customer_id and timezones is None:
+            _save_checkpoint(newsletter, last_customer_id)
+        return
+
+    # buckets of a delivery window are dispatched out of customer id
+    # order, they rely on the idempotency of the chunks instead
+    for recipients in chunks:
+        send_messages(gateway, newsletter, recipients)
+        if timezones is None:
+            _save_checkpoint(newsletter, recipients[-1].id)
+
+
+# a chunk is acknowledged only once it has been sent, so the chunk of a
+# worker that died is delivered to another one
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def send_newsletter_chunk(
+        newsletter_id: int,
+        customer_ids: list[int],
+        gateway: str = 'mailing.message_gateway.ConcurrentMessageGateway',
+) -> None:
+    with metrics.DISPATCH_SECONDS.labels('send_newsletter_chunk').time():
+        newsletter = Newsletter.objects.get(id=newsletter_id)
+        send_messages(import_string(gateway), newsletter, get_recipients(customer_ids))
+
+
+@shared_task
+def apply_task_at(task_name: str, args: list, eta: str) -> None:
+    # a hop of a task published further ahead than MAILING_MAX_ETA
+    _apply_at(current_app.tasks[task_name], tuple(args), datetime.datetime.fromisoformat(eta))
+
+
+@shared_task
+def create_message_partitions() -> None:
+    created = partitions.create_message_partitions()
+    if created:
+        logger.info(f'Message partitions created: {created}')
+
+
+@shared_task
+def retry_messages(
+        newsletter_id: int,
+        message_ids: list[int],
+        gateway: str = 'mailing.message_gateway.ConcurrentMessageGateway',
+) -> None:
+    newsletter = Newsletter.objects.get(id=newsletter_id)
+    if newsletter.finish < timezone.now():
+        logger.info(f'{newsletter.finish} already passed {timezone.now()}, retries stopped')
+        return
+
+    retries = [
+        (message_id, attempts, Recipient(*recipient))
+        for message_id, attempts, *recipient in Message.objects.filter(
+            id__in=message_ids,
+            status=Message.Status.FAILURE,
+        ).values_list('id', 'attempts', *(f'customer__{field}' for field in RECIPIENT_FIELDS))
+    ]
+    if newsletter.delivery_window_start is not None:
+        # a retry may come after the window of its recipient has closed
+        retries, deferred = _split_by_delivery_window(newsletter, retries, lambda retry: retry[2].timezone)
+        for eta, deferred_retries in deferred.items():
+            message_ids = [message_id for message_id, _, _ in deferred_retries]
+            _defer(newsletter, retry_messages, (newsletter.id, message_ids, gateway), eta)
+
+    render = _get_renderer(newsletter)
+    messages_by_attempts = defaultdict(list)
+    for message_id, attempts, recipient in retries:
+        messages_by_attempts[attempts].append(
+            OutgoingMessage(message_id, recipient.phone_number, render(recipient), recipient.mobile_operator_code)
+        )
+    for attempts, messages in messages_by_attempts.items():
+        _send(import_string(gateway), newsletter, messages, attempts)
 
 
-def send_message(
+def send_messages(
         gateway: AbstractMessageGateway,
         newsletter: Newsletter,
-        customer: Customer,
+        recipients: list[Recipient],
 ) -> None:
-    message = Message.objects.create(
+    if newsletter.delivery_window_start is not None:
+        # the window is checked when every chunk starts, recipients whose
+        # window has closed since the dispatch are sent at its next opening,
+        # so a chunk overruns the window at most by its own send time
+        recipients, deferred = _split_by_delivery_window(newsletter, recipients, operator.attrgetter('timezone'))
+        for eta, deferred_recipients in deferred.items():
+            _defer(
+                newsletter,
+                send_newsletter_chunk,
+                (newsletter.id, [recipient.id for recipient in deferred_recipients], _get_gateway_path(gateway)),
+                eta,
+            )
+        if not recipients:
+            return
+
+    recipients = {recipient.id: recipient for recipient in recipients}
+    customer_ids = list(recipients)
+
+    # messages are created only for customers that don't have one yet,
+    # so a chunk can be safely sent again. The unique constraint of the
+    # partitioned messages table includes created_at and can't enforce it,
+    # concurrent inserts of a newsletter are serialized with an advisory lock
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [newsletter.id])
+        cursor.execute(
+            f'INSERT INTO {Message._meta.db_table} '
+            f'(created_at, updated_at, status, attempts, newsletter_id, customer_id) '
+            f'SELECT %s, %s, %s, 0, %s, c.id FROM {Customer._meta.db_table} AS c '
+            f'WHERE c.id = ANY(%s) AND NOT EXISTS ('
+            f'SELECT 1 FROM {Message._meta.db_table} AS m '
+            f'WHERE m.newsletter_id = %s AND m.customer_id = c.id)',
+            [timezone.now(), timezone.now(), Message.Status.ONGOING, newsletter.id, customer_ids, newsletter.id],
+        )
+        NewsletterStats.objects.add(newsletter.id, {Message.Status.ONGOING: cursor.rowcount})
+
+    # messages that have never been sent, including the ones left by an
+    # interrupted dispatch, found through the partial message_pending_idx
+    pending_messages = Message.objects.filter(
         newsletter=newsletter,
-        customer=customer,
+        customer_id__in=customer_ids,
+        status=Message.Status.ONGOING,
+        attempts=0,
     )
     if newsletter.finish < timezone.now():
         logger.info(f'{newsletter.finish} already passed {timezone.now()}')
-        message.status = Message.Status.CANCELED
-        message.save()
+        canceled = pending_messages.update(status=Message.Status.CANCELED, updated_at=timezone.now())
+        NewsletterStats.objects.add(
+            newsletter.id,
+            {Message.Status.ONGOING: -canceled, Message.Status.CANCELED: canceled},
+        )
+        metrics.MESSAGES.labels(Message.Status.CANCELED).inc(canceled)
+        return
+
+    render = _get_renderer(newsletter)
+    _send(
+        gateway,
+        newsletter,
+        [
+            OutgoingMessage(
+                message_id,
+                recipients[customer_id].phone_number,
+                render(recipients[customer_id]),
+                recipients[customer_id].mobile_operator_code,
+            )
+            for message_id, customer_id in pending_messages.values_list('id', 'customer_id')
+        ],
+        attempts=0,
+    )
+
+
+def _get_renderer(newsletter: Newsletter) -> Callable[[Recipient], str]:
+    try:
+        message_template = get_message_template(newsletter.message_text)
+    except TemplateError as e:
+        # texts saved around the serializer, e.g. in the admin, are sent as they are
+        logger.info(f'{e}, newsletter_id: {newsletter.id}')
+        return lambda recipient: newsletter.message_text
+    return message_template.renderer(timezone.now())
+
+
+def _send(
+        gateway: AbstractMessageGateway,
+        newsletter: Newsletter,
+        messages: list[OutgoingMessage],
+        attempts: int,
+) -> None:
+    # attempts is the number of times the messages have been sent before
+    is_last_attempt = attempts + 1 >= settings.MAILING_RETRY_MAX_ATTEMPTS
+    failed_message_ids = []
+    statuses = defaultdict(int)
+    metrics.BATCH_SIZE.observe(len(messages))
+    with MessageStatusWriter() as status_writer:
+        for message_id, result in gateway.iter_send_messages(messages):
+            if result:
+                message_status = Message.Status.SUCCESS
+            elif is_last_attempt:
+                message_status = Message.Status.DEAD
+            else:
+                message_status = Message.Status.FAILURE
+                failed_message_ids.append(message_id)
+            status_writer.add(message_id, message_status)
+            statuses[message_status] += 1
+
+    for message_status, count in statuses.items():
+        metrics.MESSAGES.labels(message_status).inc(count)
+    _observe_progress(newsletter)
+
+    if failed_message_ids:
+        _schedule_retry(gateway, newsletter, failed_message_ids, attempts + 1)
+
+
+def _observe_progress(newsletter: Newsletter) -> None:
+    # stats have a counter per message status
+    progress = NewsletterStats.objects.filter(newsletter=newsletter).values(*Message.Status.values).first()
+    for message_status, count in (progress or {}).items():
+        metrics.NEWSLETTER_PROGRESS.labels(newsletter.id, message_status).set(count)
+
+
+def _schedule_retry(
+        gateway: AbstractMessageGateway,
+        newsletter: Newsletter,
+        message_ids: list[int],
+        attempts: int,
+) -> None:
+    # exponential backoff with jitter, so that retries of an outage
+    # don't hit the gateway all at once
+    delay = min(
+        settings.MAILING_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+        settings.MAILING_RETRY_MAX_DELAY,
+    )
+    countdown = delay / 2 + random.uniform(0, delay / 2)
+    eta = timezone.now() + datetime.timedelta(seconds=countdown)
+    if eta >= newsletter.finish:
+        logger.info(f'{newsletter.finish} passes before retry, message_ids: {message_ids}')
         return
+    _apply_at(retry_messages, (newsletter.id, message_ids, _get_gateway_path(gateway)), eta)
 
-    result = gateway.send_message(message.id, customer.phone_number, newsletter.message_text)
-    message.status = Message.Status.SUCCESS if result else Message.Status.FAILURE
-    message.save()
+
+def _schedule_delivery_windows(newsletter: Newsletter, gateway: AbstractMessageGateway) -> None:
+    # recipients are bucketed by the moment their local delivery window
+    # opens, i.e. by UTC offset, and every bucket is dispatched on its own
+    start = max(timezone.now(), newsletter.start)
+    buckets = defaultdict(list)
+    for customer_timezone in newsletter.get_audience().order_by().values_list('timezone', flat=True).distinct():
+        eta = _get_delivery_window_start(
+            start,
+            customer_timezone,
+            newsletter.delivery_window_start,
+            newsletter.delivery_window_end,
+        )
+        if eta >= newsletter.finish:
+            logger.info(f'{newsletter.finish} passes before delivery window in {customer_timezone}')
+            continue
+        buckets[eta].append(str(customer_timezone))
+
+    for eta, timezones in buckets.items():
+        _apply_at(send_newsletter_bucket, (newsletter.id, sorted(timezones), _get_gateway_path(gateway)), eta)
+
+
+def _split_by_delivery_window(
+        newsletter: Newsletter,
+        items: list,
+        get_timezone: Callable[..., zoneinfo.ZoneInfo],
+) -> tuple[list, dict[datetime.datetime, list]]:
+    """
+    Split items into the ones whose recipient's delivery window is open
+    now and the others by the moment their window opens next.
+    """
+    now = timezone.now()
+    window_starts = {}
+    open_items = []
+    deferred = defaultdict(list)
+    for item in items:
+        tz = get_timezone(item)
+        try:
+            window_start = window_starts[tz]
+        except KeyError:
+            window_start = window_starts[tz] = _get_delivery_window_start(
+                now,
+                tz,
+                newsletter.delivery_window_start,
+                newsletter.delivery_window_end,
+            )
+        if window_start == now:
+            open_items.append(item)
+        else:
+            deferred[window_start].append(item)
+    return open_items, deferred
+
+
+def _defer(newsletter: Newsletter, task: Task, args: tuple, eta: datetime.datetime) -> None:
+    if eta >= newsletter.finish:
+        logger.info(f'{newsletter.finish} passes before delivery window, {task.name} args: {args}')
+        return
+    _apply_at(task, args, eta)
+
+
+def _apply_at(task: Task, args: tuple, eta: datetime.datetime) -> None:
+    # redis hands a task over to a worker right away, eta or not, and to
+    # another one if it isn't acknowledged within the visibility timeout,
+    # so tasks further ahead than MAILING_MAX_ETA are published in hops
+    hop_eta = timezone.now() + datetime.timedelta(seconds=settings.MAILING_MAX_ETA)
+    if eta > hop_eta:
+        apply_task_at.apply_async((task.name, list(args), eta.isoformat()), eta=hop_eta)
+        return
+    task.apply_async(args, eta=eta)
+
+
+def _get_delivery_window_start(
+        moment: datetime.datetime,
+        tz: zoneinfo.ZoneInfo,
+        window_start: datetime.time,
+        window_end: datetime.time,
+) -> datetime.datetime:
+    local_moment = moment.astimezone(tz)
+    local_time = local_moment.time()
+    if window_start <= window_end:
+        is_open = window_start <= local_time < window_end
+    else:
+        # the window wraps midnight, e.g. 22:00 - 06:00
+        is_open = local_time >= window_start or local_time < window_end
+    if is_open:
+        return moment
+
+    window_opens_at = datetime.datetime.combine(local_moment.date(), window_start, tzinfo=tz)
+    if window_opens_at <= local_moment:
+        window_opens_at += datetime.timedelta(days=1)
+    return window_opens_at.astimezone(datetime.timezone.utc)
+
+
+def _get_gateway_path(gateway: AbstractMessageGateway) -> str:
+    # tasks get the gateway by its import path, classes aren't serializable
+    return f'{gateway.__module__}.{gateway.__qualname__}'
+
+
+def _save_checkpoint(newsletter: Newsletter, last_customer_id: int) -> None:
+    DispatchCheckpoint.objects.update_or_create(
+        newsletter=newsletter,
+        defaults={'last_customer_id': last_customer_id},
+    )
+
+
+def _get_audience(
+        newsletter: Newsletter,
+        last_customer_id: int,
+        timezones: list[str] | None,
+) -> models.QuerySet[Customer]:
+    audience = newsletter.get_audience().filter(id__gt=last_customer_id)
+    if timezones is not None:
+        audience = audience.filter(timezone__in=timezones)
+    return audience
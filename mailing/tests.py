@@ -1,11 +1,42 @@
+import csv
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import zoneinfo
-from datetime import datetime
+from datetime import datetime, time, timedelta
+from datetime import timezone as dt_timezone
+from unittest import mock
 
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from fakeredis import FakeRedis
+from prometheus_client import REGISTRY
+from requests import Timeout
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from .models import Customer, MailingTask, Message, Newsletter
+from . import partitions, tasks
+from .admin import ApproximateCountPaginator, NewsletterListFilter
+from .benchmark import FakeMessageGateway
+from .message_gateway import (ConcurrentMessageGateway, MessageGateway,
+                              OutgoingMessage)
+from .message_template import (ESCAPING_HINT, MessageTemplate, TemplateError,
+                               escape)
+from .models import (Customer, DispatchCheckpoint, MailingTask, Message,
+                     MessageArchive, Newsletter, NewsletterStats)
+from .rate_limiter import TokenBucketRateLimiter, _get_token_bucket_script
+from .recipients import Recipient
+from .status_writer import MessageStatusWriter
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S%z'
 DEFAULT_MOBILE_OPERATOR_CODES = ['903', '910', '920']
@@ -90,12 +121,113 @@ class CustomerTests(APITestCase):
                 {'phone_number': ['should be in the format 7XXXXXXXXXX']},
             )
 
+    def test_bulk_import_customers(self):
+        """
+        Ensure customers are upserted from a CSV file, invalid rows are
+        reported and newsletter membership is computed for the imported set.
+        """
+        newsletter = _create_newsletter(
+            finish=timezone.now() + timedelta(days=1),
+            tags=['manager'],
+        )
+        existing_customer = _create_customer(phone_number='79991234560', tag='gamer')
+        content = (
+            'phone_number,mobile_operator_code,tag,timezone\n'
+            '79991234560,903,manager,Asia/Bangkok\n'
+            '79991234561,910,gamer,\n'
+            '7999123456,910,gamer,Asia/Bangkok\n'
+            '79991234562,910,manager,Mars/Olympus\n'
+        )
+        url = reverse('customer-bulk-import')
+        response = self.client.post(
+            url,
+            {'file': SimpleUploadedFile('customers.csv', content.encode())},
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {
+            'imported': 2,
+            'invalid': 2,
+            'errors': [
+                {'row': 3, 'errors': {'phone_number': 'should be in the format 7XXXXXXXXXX'}},
+                {'row': 4, 'errors': {'timezone': 'unknown time zone'}},
+            ],
+        })
+        self.assertEqual(Customer.objects.count(), 2)
+        existing_customer.refresh_from_db()
+        self.assertEqual(existing_customer.tag, 'manager')
+        self.assertEqual(list(newsletter.customers.all()), [existing_customer])
+
+    def test_bulk_import_customers_with_bom(self):
+        """
+        Ensure a CSV file saved with a UTF-8 byte order mark is imported.
+        """
+        content = (
+            'phone_number,mobile_operator_code,tag,timezone\n'
+            '79991234560,903,manager,Asia/Bangkok\n'
+        )
+        url = reverse('customer-bulk-import')
+        response = self.client.post(
+            url,
+            {'file': SimpleUploadedFile('customers.csv', content.encode('utf-8-sig'))},
+            format='multipart',
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'imported': 1, 'invalid': 0, 'errors': []})
+        self.assertEqual(Customer.objects.get().phone_number, '79991234560')
+
+    def test_import_customers_command(self):
+        """
+        Ensure customers can be imported from a JSONL file.
+        """
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as file:
+            file.write(
+                '{"phone_number": "79991234560", "mobile_operator_code": "903", "tag": "gamer"}\n'
+                '{"phone_number": "79991234561", "mobile_operator_code": "903", "tag": "gamer"}\n'
+                '{"phone_number": "79991234560", "mobile_operator_code": "910", "tag": "gamer"}\n'
+            )
+            file.flush()
+            call_command('import_customers', file.name, stdout=io.StringIO())
+
+        self.assertEqual(Customer.objects.count(), 2)
+        self.assertEqual(Customer.objects.get(phone_number='79991234560').mobile_operator_code, '910')
+
+    def test_bulk_update_customers(self):
+        """
+        Ensure customers are re-tagged at once and moved between newsletters
+        with a constant number of queries.
+        """
+        gamers_newsletter = _create_newsletter(finish=timezone.now() + timedelta(days=1), tags=['gamer'])
+        managers_newsletter = _create_newsletter(finish=timezone.now() + timedelta(days=1), tags=['manager'])
+        customers = [_create_customer(phone_number=f'7999123456{i}', tag='gamer') for i in range(3)]
+
+        url = reverse('customer-bulk-update')
+        with self.assertNumQueries(7):
+            response = self.client.patch(
+                url,
+                {'ids': [customer.id for customer in customers[:2]], 'tag': 'manager'},
+                format='json',
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), {'updated': 2})
+        self.assertEqual(list(gamers_newsletter.customers.all()), [customers[2]])
+        self.assertEqual(list(managers_newsletter.customers.order_by('id')), customers[:2])
+
+        response = self.client.patch(url, {'ids': [customers[0].id]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # the set is filtered on the field that is being updated
+        self.assertEqual(Customer.objects.filter(tag='gamer').resegment(tag='manager'), 1)
+        self.assertFalse(gamers_newsletter.customers.exists())
+        self.assertEqual(list(managers_newsletter.customers.order_by('id')), customers)
+
     def test_added_to_newsletter(self):
         """
         Ensure customer have been added to a newsletter that matched by
         mobile_operator_code and tag.
         """
         newsletter = _create_newsletter(
+            finish=timezone.now() + timedelta(days=1),
             mobile_operator_codes=DEFAULT_MOBILE_OPERATOR_CODES,
             tags=DEFAULT_TAGS,
         )
@@ -105,12 +237,28 @@ class CustomerTests(APITestCase):
         )
         self.assertEqual(newsletter.customers.first(), customer)
 
+    def test_not_added_to_finished_newsletter(self):
+        """
+        Ensure customer isn't added to a newsletter that has already finished.
+        """
+        newsletter = _create_newsletter(
+            finish=timezone.now() - timedelta(days=1),
+            mobile_operator_codes=DEFAULT_MOBILE_OPERATOR_CODES,
+            tags=DEFAULT_TAGS,
+        )
+        _create_customer(
+            mobile_operator_code=DEFAULT_MOBILE_OPERATOR_CODES[0],
+            tag=DEFAULT_TAGS[0],
+        )
+        self.assertEqual(newsletter.customers.count(), 0)
+
     def test_removed_from_newsletter_after_tag_changed(self):
         """
         Ensure customer has been removed from a newsletter if he doesn't
         match tag anymore.
         """
         newsletter = _create_newsletter(
+            finish=timezone.now() + timedelta(days=1),
             mobile_operator_codes=DEFAULT_MOBILE_OPERATOR_CODES,
             tags=DEFAULT_TAGS,
         )
@@ -130,6 +278,7 @@ class CustomerTests(APITestCase):
         match mobile_operator_codes anymore.
         """
         newsletter = _create_newsletter(
+            finish=timezone.now() + timedelta(days=1),
             mobile_operator_codes=DEFAULT_MOBILE_OPERATOR_CODES,
             tags=DEFAULT_TAGS,
         )
@@ -169,6 +318,22 @@ class NewsletterTests(APITestCase):
         self.assertEqual(newsletter.mobile_operator_codes, data.get('mobile_operator_codes'))
         self.assertEqual(newsletter.tags, data.get('tags'))
 
+    def test_newsletter_message_template_validated(self):
+        """
+        Ensure a message text with an unknown placeholder is rejected.
+        """
+        url = reverse('newsletter-list')
+        data = {
+            'start': '2023-10-01 00:00:00+00:00',
+            'finish': '2023-10-02 00:00:00+00:00',
+            'message_text': 'Hi, {name}!',
+            'mobile_operator_codes': DEFAULT_MOBILE_OPERATOR_CODES,
+            'tags': DEFAULT_TAGS,
+        }
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('message_text', response.json())
+
     def test_update_newsletter(self):
         """
         Ensure we can update a newsletter object.
@@ -233,6 +398,96 @@ class NewsletterTests(APITestCase):
             self.assertTrue(customer.mobile_operator_code in data.get('mobile_operator_codes'))
             self.assertTrue(customer.tag in data.get('tags'))
 
+    def test_list_newsletters(self):
+        """
+        Ensure newsletters are listed page by page with a recipient count
+        instead of nested customers.
+        """
+        for i in range(3):
+            _create_customer(phone_number=f'7999123456{i}')
+        newsletters = [_create_newsletter() for _ in range(3)]
+
+        url = reverse('newsletter-list')
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        result = response.json()
+        self.assertEqual([newsletter['id'] for newsletter in result['results']],
+                         [newsletter.id for newsletter in newsletters[:2]])
+        self.assertEqual(result['results'][0]['customers_count'], 3)
+        self.assertNotIn('customers', result['results'][0])
+
+        response = self.client.get(result['next'])
+        self.assertEqual([newsletter['id'] for newsletter in response.json()['results']],
+                         [newsletters[2].id])
+
+    def test_list_newsletters_with_dynamic_audience(self):
+        """
+        Ensure a dynamic audience newsletter is listed without a recipient
+        count, its audience isn't counted for every listed newsletter.
+        """
+        for i in range(3):
+            _create_customer(phone_number=f'7999123456{i}')
+        _create_customer(phone_number='79991234563', tag='reader')
+        newsletter = _create_newsletter()
+        newsletter.dynamic_audience = True
+        newsletter.save()
+
+        response = self.client.get(reverse('newsletter-list'))
+        self.assertIsNone(response.json()['results'][0]['customers_count'])
+
+        response = self.client.get(reverse('newsletter-detail', kwargs={'pk': newsletter.id}))
+        self.assertNotIn('customers', response.json())
+
+    def test_list_newsletter_customers(self):
+        """
+        Ensure newsletter customers are listed page by page.
+        """
+        customers = [_create_customer(phone_number=f'7999123456{i}') for i in range(3)]
+        newsletter = _create_newsletter()
+
+        url = reverse(
+            'newsletter-customers',
+            kwargs={'pk': newsletter.id}
+        )
+        response = self.client.get(url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        result = response.json()
+        self.assertEqual([customer['id'] for customer in result['results']],
+                         [customer.id for customer in customers[:2]])
+        self.assertIsNotNone(result['next'])
+
+    def test_customers_replaced_after_filter_changed(self):
+        """
+        Ensure customers that don't match the new filter are removed and
+        the ones that match it are added.
+        """
+        gamer = _create_customer(phone_number='79991234560', tag='gamer')
+        manager = _create_customer(phone_number='79991234561', tag='manager')
+        newsletter = _create_newsletter(tags=['gamer'])
+        self.assertEqual(list(newsletter.customers.all()), [gamer])
+
+        url = reverse(
+            'newsletter-detail',
+            kwargs={'pk': newsletter.id}
+        )
+        response = self.client.patch(url, {'tags': ['manager']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(newsletter.customers.all()), [manager])
+
+    def test_customers_kept_after_message_text_changed(self):
+        """
+        Ensure the audience isn't recomputed if the filter hasn't been changed.
+        """
+        _create_customer()
+        newsletter = _create_newsletter()
+        newsletter.message_text = 'Text after update'
+        with CaptureQueriesContext(connection) as queries:
+            newsletter.save()
+
+        customers_table = Newsletter.customers.through._meta.db_table
+        self.assertFalse(any(customers_table in query['sql'] for query in queries))
+        self.assertEqual(newsletter.customers.count(), 1)
+
     def test_periodic_task_has_been_created(self):
         """
         Ensure mailing task with correct clocked schedule has been created.
@@ -254,6 +509,32 @@ class NewsletterTests(APITestCase):
         self.assertTrue(mailing_task.enabled, True)
         self.assertEqual(mailing_task.clocked.clocked_time, datetime.strptime(data.get('start'), DATE_FORMAT))
 
+    @override_settings(MAILING_SCHEDULER='poller')
+    def test_dispatch_due_newsletters(self):
+        """
+        Ensure the poller claims due newsletters once and sends only the
+        ones that haven't finished yet.
+        """
+        now = timezone.now()
+        due_newsletter = _create_newsletter(start=now - timedelta(minutes=1), finish=now + timedelta(days=1))
+        finished_newsletter = _create_newsletter(start=now - timedelta(days=2), finish=now - timedelta(days=1))
+        future_newsletter = _create_newsletter(start=now + timedelta(days=1), finish=now + timedelta(days=2))
+        self.assertFalse(MailingTask.objects.exists())
+
+        with (
+            mock.patch.object(tasks.send_newsletter, 'delay') as delay,
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            tasks.dispatch_due_newsletters()
+            tasks.dispatch_due_newsletters()
+
+        delay.assert_called_once_with(due_newsletter.id)
+        self.assertEqual(
+            set(Newsletter.objects.filter(dispatched_at__isnull=False).values_list('id', flat=True)),
+            {due_newsletter.id, finished_newsletter.id},
+        )
+        self.assertIsNone(Newsletter.objects.get(id=future_newsletter.id).dispatched_at)
+
     def test_newsletter_overall_stats(self):
         """
         Check newsletter stats annotated values.
@@ -283,13 +564,1033 @@ class NewsletterTests(APITestCase):
         url = reverse('newsletter-stats-list')
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        result = response.json()[0]
+        result = response.json()['results'][0]
         self.assertEqual(result.get('success'), 3)
         self.assertEqual(result.get('ongoing'), 2)
         self.assertEqual(result.get('failure'), 3)
         self.assertEqual(result.get('canceled'), 2)
 
 
+class SendNewsletterTests(TestCase):
+
+    def setUp(self):
+        FakeMessageGateway.reset(record=True)
+        for i in range(5):
+            _create_customer(phone_number=f'7999123456{i}')
+        self.newsletter = _create_newsletter(
+            start=timezone.now(),
+            finish=timezone.now() + timedelta(days=1),
+        )
+
+    @override_settings(MAILING_CHUNK_SIZE=2)
+    def test_send_newsletter_in_chunks(self):
+        """
+        Ensure every customer gets exactly one message when the audience
+        is split into several chunks.
+        """
+        FakeMessageGateway.failing_phone_numbers = {'79991234563'}
+        with mock.patch.object(tasks.retry_messages, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        self.assertEqual(len(FakeMessageGateway.sent), 5)
+        self.assertEqual(self.newsletter.messages.count(), 5)
+        self.assertEqual(
+            self.newsletter.messages.filter(status=Message.Status.SUCCESS).count(), 4)
+        failed_message = self.newsletter.messages.get(status=Message.Status.FAILURE)
+        self.assertEqual(failed_message.customer.phone_number, '79991234563')
+        self.assertEqual(failed_message.attempts, 1)
+        self.assertEqual(
+            apply_async.call_args.args[0],
+            (self.newsletter.id, [failed_message.id], 'mailing.benchmark.FakeMessageGateway'),
+        )
+
+        stats = NewsletterStats.objects.get(newsletter=self.newsletter)
+        self.assertEqual(
+            (stats.success, stats.ongoing, stats.failure, stats.canceled, stats.dead),
+            (4, 0, 1, 0, 0),
+        )
+
+    def test_send_newsletter_message_template(self):
+        """
+        Ensure every recipient gets the message text rendered for them.
+        """
+        Customer.objects.filter(phone_number='79991234560').update(tag='manager', timezone='Asia/Vladivostok')
+        self.newsletter.message_text = 'Hi, {tag}! {{{local_date}}}'
+        self.newsletter.save()
+        tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        local_date = timezone.now().astimezone(zoneinfo.ZoneInfo('Asia/Vladivostok')).date()
+        texts = {phone_number: text for _, phone_number, text in FakeMessageGateway.sent}
+        self.assertEqual(texts['79991234560'], f'Hi, manager! {{{local_date}}}')
+        self.assertTrue(texts['79991234561'].startswith('Hi, gamer! {'))
+
+    def test_send_newsletter_twice(self):
+        """
+        Ensure dispatching a newsletter again doesn't duplicate messages.
+        """
+        tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+        tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        self.assertEqual(len(FakeMessageGateway.sent), 5)
+        self.assertEqual(self.newsletter.messages.count(), 5)
+        self.assertEqual(NewsletterStats.objects.get(newsletter=self.newsletter).success, 5)
+
+    @override_settings(MAILING_CHUNK_SIZE=2)
+    def test_resume_newsletter(self):
+        """
+        Ensure an interrupted dispatch continues from its checkpoint and
+        sends the messages that were created but never sent.
+        """
+        customers = list(self.newsletter.customers.order_by('id'))
+        _create_message(self.newsletter, customers[0], Message.Status.SUCCESS)
+        _create_message(self.newsletter, customers[1])
+        DispatchCheckpoint.objects.create(newsletter=self.newsletter, last_customer_id=customers[1].id)
+        _create_message(self.newsletter, customers[2])
+
+        tasks.resume_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        self.assertEqual(
+            sorted(phone_number for _, phone_number, _ in FakeMessageGateway.sent),
+            [customer.phone_number for customer in customers[2:]],
+        )
+        self.assertEqual(DispatchCheckpoint.objects.get().last_customer_id, customers[-1].id)
+
+    def test_send_finished_newsletter(self):
+        """
+        Ensure messages of a finished newsletter are canceled and not sent.
+        """
+        Newsletter.objects.filter(id=self.newsletter.id).update(
+            finish=timezone.now() - timedelta(minutes=1))
+        tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        self.assertEqual(FakeMessageGateway.sent, [])
+        self.assertEqual(
+            self.newsletter.messages.filter(status=Message.Status.CANCELED).count(), 5)
+
+    def test_send_newsletter_dynamic_audience(self):
+        """
+        Ensure a dynamic audience newsletter isn't materialized and sends
+        to the customers that match its filter at send time.
+        """
+        newsletter = _create_newsletter(
+            start=timezone.now(),
+            finish=timezone.now() + timedelta(days=1),
+            tags=['manager'],
+        )
+        newsletter.dynamic_audience = True
+        newsletter.save()
+        _create_customer(phone_number='79997654321', tag='manager')
+        self.assertEqual(newsletter.customers.count(), 0)
+
+        tasks.send_newsletter(newsletter.id, FakeMessageGateway, fan_out=False)
+        self.assertEqual(
+            [phone_number for _, phone_number, _ in FakeMessageGateway.sent],
+            ['79997654321'],
+        )
+
+    def test_retry_failed_messages(self):
+        """
+        Ensure failed messages are resent and moved to the dead status
+        after the last attempt.
+        """
+        customer = Customer.objects.get(phone_number='79991234560')
+        message = _create_message(self.newsletter, customer, Message.Status.FAILURE)
+        Message.objects.filter(id=message.id).update(attempts=4)
+        FakeMessageGateway.failing_phone_numbers = {customer.phone_number}
+
+        with (
+            override_settings(MAILING_RETRY_MAX_ATTEMPTS=5),
+            mock.patch.object(tasks.retry_messages, 'apply_async') as apply_async,
+        ):
+            tasks.retry_messages(self.newsletter.id, [message.id], 'mailing.benchmark.FakeMessageGateway')
+
+        message.refresh_from_db()
+        self.assertEqual((message.status, message.attempts), (Message.Status.DEAD, 5))
+        apply_async.assert_not_called()
+
+    def test_retry_stops_after_finish(self):
+        """
+        Ensure a retry isn't scheduled past the newsletter finish.
+        """
+        Newsletter.objects.filter(id=self.newsletter.id).update(
+            finish=timezone.now() + timedelta(seconds=1))
+        FakeMessageGateway.failing_phone_numbers = {'79991234560'}
+        with mock.patch.object(tasks.retry_messages, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        apply_async.assert_not_called()
+        self.assertEqual(
+            self.newsletter.messages.filter(status=Message.Status.FAILURE).count(), 1)
+
+    def test_send_newsletter_delivery_window(self):
+        """
+        Ensure recipients are bucketed by the moment their local delivery
+        window opens.
+        """
+        Customer.objects.filter(phone_number__in=['79991234560', '79991234561']).update(timezone='Europe/Moscow')
+        Customer.objects.filter(phone_number='79991234562').update(timezone='Asia/Novosibirsk')
+        start = datetime.combine(timezone.now().date() + timedelta(days=2), time(0), tzinfo=dt_timezone.utc)
+        Newsletter.objects.filter(id=self.newsletter.id).update(
+            start=start,
+            finish=start + timedelta(days=1),
+            delivery_window_start=time(10),
+            delivery_window_end=time(20),
+        )
+        with (
+            override_settings(MAILING_MAX_ETA=7 * 24 * 60 * 60),
+            mock.patch.object(tasks.send_newsletter_bucket, 'apply_async') as apply_async,
+        ):
+            tasks.send_newsletter(self.newsletter.id, FakeMessageGateway)
+
+        self.assertEqual(FakeMessageGateway.sent, [])
+        self.assertEqual(
+            sorted((call.kwargs['eta'], call.args[0][1]) for call in apply_async.call_args_list),
+            [
+                # 10:00 in UTC+7
+                (start + timedelta(hours=3), ['Asia/Bangkok', 'Asia/Novosibirsk']),
+                # 10:00 in UTC+3
+                (start + timedelta(hours=7), ['Europe/Moscow']),
+            ],
+        )
+
+    def test_delivery_window_is_published_in_hops(self):
+        """
+        Ensure a task due further ahead than MAILING_MAX_ETA is published
+        again until its eta is close enough.
+        """
+        eta = timezone.now() + timedelta(hours=20)
+        with mock.patch.object(tasks.apply_task_at, 'apply_async') as apply_async:
+            tasks._apply_at(tasks.send_newsletter_bucket, (self.newsletter.id, ['Asia/Bangkok']), eta)
+
+        (task_name, args, hop_eta), = apply_async.call_args.args
+        self.assertEqual(task_name, tasks.send_newsletter_bucket.name)
+        self.assertEqual((args, hop_eta), ([self.newsletter.id, ['Asia/Bangkok']], eta.isoformat()))
+        self.assertLessEqual(apply_async.call_args.kwargs['eta'], timezone.now() + timedelta(seconds=1800))
+
+        with (
+            override_settings(MAILING_MAX_ETA=24 * 60 * 60),
+            mock.patch.object(tasks.send_newsletter_bucket, 'apply_async') as apply_async,
+        ):
+            tasks.apply_task_at(task_name, args, hop_eta)
+
+        apply_async.assert_called_once_with((self.newsletter.id, ['Asia/Bangkok']), eta=eta)
+
+    @override_settings(MAILING_MAX_ETA=24 * 60 * 60)
+    def test_delivery_window_is_checked_at_send_time(self):
+        """
+        Ensure recipients and retries whose delivery window has closed
+        are deferred to its next opening instead of being sent.
+        """
+        Customer.objects.filter(phone_number__in=['79991234560', '79991234561']).update(timezone='Europe/Moscow')
+        moscow_now = timezone.now().astimezone(zoneinfo.ZoneInfo('Europe/Moscow')).replace(second=0, microsecond=0)
+        # open in Moscow, closed in Bangkok four hours ahead of it
+        Newsletter.objects.filter(id=self.newsletter.id).update(
+            finish=timezone.now() + timedelta(days=2),
+            delivery_window_start=(moscow_now - timedelta(hours=1)).time(),
+            delivery_window_end=(moscow_now + timedelta(hours=1)).time(),
+        )
+        bangkok_customer = Customer.objects.get(phone_number='79991234562')
+        failed_message = _create_message(self.newsletter, bangkok_customer, Message.Status.FAILURE)
+        window_opens_at = moscow_now + timedelta(hours=19)
+
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.dispatch_newsletter(
+                Newsletter.objects.get(id=self.newsletter.id),
+                FakeMessageGateway,
+                fan_out=False,
+                last_customer_id=0,
+                timezones=['Asia/Bangkok', 'Europe/Moscow'],
+            )
+
+        self.assertEqual(
+            sorted(phone_number for _, phone_number, _ in FakeMessageGateway.sent),
+            ['79991234560', '79991234561'],
+        )
+        (newsletter_id, customer_ids, gateway), = apply_async.call_args.args
+        self.assertEqual(gateway, 'mailing.benchmark.FakeMessageGateway')
+        self.assertEqual(
+            sorted(Customer.objects.filter(id__in=customer_ids).values_list('phone_number', flat=True)),
+            ['79991234562', '79991234563', '79991234564'],
+        )
+        self.assertEqual(apply_async.call_args.kwargs['eta'], window_opens_at)
+
+        with mock.patch.object(tasks.retry_messages, 'apply_async') as apply_async:
+            tasks.retry_messages(self.newsletter.id, [failed_message.id], 'mailing.benchmark.FakeMessageGateway')
+
+        apply_async.assert_called_once_with(
+            (self.newsletter.id, [failed_message.id], 'mailing.benchmark.FakeMessageGateway'),
+            eta=window_opens_at,
+        )
+        failed_message.refresh_from_db()
+        self.assertEqual(failed_message.attempts, 0)
+
+    @override_settings(MAILING_CHUNK_SIZE=2)
+    def test_send_newsletter_fan_out(self):
+        """
+        Ensure fan-out mode enqueues keyset paginated chunks sent through
+        the gateway of the dispatch.
+        """
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=True)
+
+        customer_ids = list(
+            self.newsletter.customers.order_by('id').values_list('id', flat=True))
+        self.assertEqual(
+            [call.args[0] for call in apply_async.call_args_list],
+            [
+                (self.newsletter.id, customer_ids[:2], 'mailing.benchmark.FakeMessageGateway'),
+                (self.newsletter.id, customer_ids[2:4], 'mailing.benchmark.FakeMessageGateway'),
+                (self.newsletter.id, customer_ids[4:], 'mailing.benchmark.FakeMessageGateway'),
+            ],
+        )
+
+        tasks.send_newsletter_chunk(*apply_async.call_args_list[0].args[0])
+        self.assertEqual(len(FakeMessageGateway.sent), 2)
+
+    @override_settings(MAILING_CHUNK_SIZE=2, MAILING_OPERATOR_QUEUES=['916'], MAILING_PRIORITY_MAX_RECIPIENTS=4)
+    def test_send_newsletter_fan_out_queues(self):
+        """
+        Ensure chunks are routed to the queues of their mobile operators
+        and small newsletters to the priority queue, whatever part of the
+        audience is dispatched or how close the finish is.
+        """
+        Customer.objects.filter(phone_number__in=['79991234561', '79991234563']).update(mobile_operator_code='916')
+        customer_ids = list(self.newsletter.customers.order_by('id').values_list('id', flat=True))
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, fan_out=True)
+
+        self.assertEqual(
+            [(call.kwargs['queue'], call.args[0][1]) for call in apply_async.call_args_list],
+            [
+                ('mailing.send', [customer_ids[0], customer_ids[2]]),
+                ('mailing.send.916', [customer_ids[1], customer_ids[3]]),
+                ('mailing.send', [customer_ids[4]]),
+            ],
+        )
+        self.assertEqual(DispatchCheckpoint.objects.get().last_customer_id, customer_ids[4])
+
+        # a resumed dispatch of a single recipient is still a big newsletter
+        DispatchCheckpoint.objects.update(last_customer_id=customer_ids[3])
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.resume_newsletter(self.newsletter.id, fan_out=True)
+
+        self.assertEqual([call.kwargs['queue'] for call in apply_async.call_args_list], ['mailing.send'])
+
+        # a big newsletter close to its finish isn't sent as a priority
+        self.newsletter.finish = timezone.now() + timedelta(minutes=30)
+        self.newsletter.save()
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, fan_out=True)
+
+        self.assertNotIn('mailing.priority', {call.kwargs['queue'] for call in apply_async.call_args_list})
+
+        Customer.objects.filter(id=customer_ids[4]).delete()
+        with mock.patch.object(tasks.send_newsletter_chunk, 'apply_async') as apply_async:
+            tasks.send_newsletter(self.newsletter.id, fan_out=True)
+
+        self.assertEqual(
+            {call.kwargs['queue'] for call in apply_async.call_args_list},
+            {'mailing.priority'},
+        )
+
+    def test_send_newsletter_progress_gauge(self):
+        """
+        Ensure the progress gauge follows the newsletter stats.
+        """
+        tasks.send_newsletter(self.newsletter.id, FakeMessageGateway, fan_out=False)
+
+        self.assertEqual(
+            REGISTRY.get_sample_value(
+                'mailing_newsletter_progress',
+                {'newsletter_id': str(self.newsletter.id), 'status': Message.Status.SUCCESS},
+            ),
+            5,
+        )
+
+
+# sends a newsletter in a process of its own and prints the number of
+# messages sent and the growth of the peak RSS in kilobytes
+SEND_NEWSLETTER_MEMORY_SCRIPT = """
+import resource
+import sys
+
+import django
+
+django.setup()
+
+from django.conf import settings
+
+from mailing import tasks
+from mailing.benchmark import FakeMessageGateway
+
+settings.DEBUG = False
+FakeMessageGateway.reset()
+rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+tasks.send_newsletter(int(sys.argv[1]), FakeMessageGateway, fan_out=False)
+rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(len(FakeMessageGateway.latencies), rss_after - rss_before)
+"""
+
+
+@tag('slow')
+class SendNewsletterMemoryTests(TransactionTestCase):
+    RECIPIENTS = 500_000
+    # growth of the peak RSS while sending, independent of the audience
+    # size, loading the whole audience would take several times more
+    MEMORY_CEILING_KB = 64 * 1024
+
+    def test_send_newsletter_memory_is_bounded(self):
+        """
+        Ensure sending to a large audience streams recipients instead of
+        loading them all into memory.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {Customer._meta.db_table} '
+                f'(phone_number, mobile_operator_code, tag, timezone, created_at, updated_at) '
+                f'SELECT (79000000000 + i)::text, %s, %s, %s, now(), now() '
+                f'FROM generate_series(1, %s) AS i',
+                ['903', 'gamer', 'Europe/Moscow', self.RECIPIENTS],
+            )
+        newsletter = _create_newsletter(
+            start=timezone.now(),
+            finish=timezone.now() + timedelta(days=1),
+        )
+        newsletter.dynamic_audience = True
+        newsletter.save()
+
+        # the data is committed, the process reads the test database
+        result = subprocess.run(
+            [sys.executable, '-c', SEND_NEWSLETTER_MEMORY_SCRIPT, str(newsletter.id)],
+            env={
+                **os.environ,
+                'DJANGO_SETTINGS_MODULE': 'core.settings',
+                'POSTGRES_DB': connection.settings_dict['NAME'],
+            },
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        sent, rss_growth = map(int, result.stdout.split())
+
+        self.assertEqual(sent, self.RECIPIENTS)
+        self.assertLess(rss_growth, self.MEMORY_CEILING_KB)
+
+
+class MessageGatewayTests(TestCase):
+
+    def test_concurrent_gateway_result_map(self):
+        """
+        Ensure a batch is sent through the shared session and every
+        message gets its own result.
+        """
+        session = mock.Mock()
+        session.post.side_effect = lambda url, **kwargs: mock.Mock(
+            status_code=status.HTTP_200_OK if kwargs['json']['id'] % 2 else status.HTTP_400_BAD_REQUEST,
+        )
+        messages = [OutgoingMessage(i, f'7999123456{i}', 'Newsletter test') for i in range(10)]
+        with mock.patch.object(MessageGateway, 'get_session', return_value=session):
+            results = ConcurrentMessageGateway.send_messages(messages)
+
+        self.assertEqual(session.post.call_count, 10)
+        self.assertEqual(results, {i: bool(i % 2) for i in range(10)})
+
+    def test_throttled_message_is_resent(self):
+        """
+        Ensure a 429 response pauses the shared rate limiter for Retry-After
+        seconds and the message is sent again.
+        """
+        session = mock.Mock()
+        session.post.side_effect = [
+            mock.Mock(status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '2'}),
+            mock.Mock(status_code=status.HTTP_200_OK),
+        ]
+        rate_limiter = mock.Mock()
+        with (
+            mock.patch.object(MessageGateway, 'get_session', return_value=session),
+            mock.patch('mailing.message_gateway.get_rate_limiter', return_value=rate_limiter),
+        ):
+            results = MessageGateway.send_messages(
+                [OutgoingMessage(1, '79991234560', 'Newsletter test', '903')])
+
+        self.assertEqual(results, {1: True})
+        self.assertEqual(rate_limiter.acquire.call_count, 2)
+        rate_limiter.block.assert_called_once_with(2.0)
+
+    @override_settings(MAILING_MAX_RETRY_AFTER=60)
+    def test_long_retry_after_is_not_waited(self):
+        """
+        Ensure a Retry-After above MAILING_MAX_RETRY_AFTER fails the message
+        for the backoff retry instead of pausing the workers.
+        """
+        session = mock.Mock()
+        session.post.return_value = mock.Mock(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={'Retry-After': '3600'})
+        rate_limiter = mock.Mock()
+        with (
+            mock.patch.object(MessageGateway, 'get_session', return_value=session),
+            mock.patch('mailing.message_gateway.get_rate_limiter', return_value=rate_limiter),
+        ):
+            results = MessageGateway.send_messages(
+                [OutgoingMessage(1, '79991234560', 'Newsletter test', '903')])
+
+        self.assertEqual(results, {1: False})
+        self.assertEqual(session.post.call_count, 1)
+        rate_limiter.block.assert_not_called()
+
+    def test_gateway_timeout_is_counted(self):
+        """
+        Ensure a timed out request is counted and its latency observed.
+        """
+        labels = {'gateway': 'MessageGateway', 'outcome': 'timeout'}
+        timeouts = REGISTRY.get_sample_value('mailing_gateway_requests_total', labels) or 0
+        session = mock.Mock()
+        session.post.side_effect = Timeout()
+        with mock.patch.object(MessageGateway, 'get_session', return_value=session):
+            result = MessageGateway.send_message(1, '79991234560', 'Newsletter test')
+
+        self.assertFalse(result)
+        self.assertEqual(REGISTRY.get_sample_value('mailing_gateway_requests_total', labels), timeouts + 1)
+        self.assertIsNotNone(
+            REGISTRY.get_sample_value('mailing_gateway_request_seconds_count', {'gateway': 'MessageGateway'}))
+
+
+class TokenBucketRateLimiterTests(TestCase):
+
+    def setUp(self):
+        # the script runs in fakeredis, which reads the clock through
+        # time.time(); waiting in acquire() moves the clock forward
+        self.now = 1_700_000_000.0
+        self.sleeps = []
+        clock = mock.Mock(time=lambda: self.now)
+        for patcher in (
+            mock.patch('mailing.rate_limiter._get_redis', return_value=FakeRedis()),
+            mock.patch('fakeredis.commands_mixins.server_mixin.time', clock),
+            mock.patch('fakeredis._socket._base.time', clock),
+            mock.patch('mailing.rate_limiter.time.sleep', side_effect=self.sleep),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        _get_token_bucket_script.cache_clear()
+        self.addCleanup(_get_token_bucket_script.cache_clear)
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def take(self, rate_limiter):
+        return _get_token_bucket_script()(
+            keys=[rate_limiter._bucket_key, rate_limiter._blocked_key],
+            args=[rate_limiter.rate, rate_limiter.capacity],
+        )
+
+    def test_burst_capacity(self):
+        """
+        Ensure a full bucket gives out `capacity` tokens at once and then
+        returns the milliseconds to wait for the next one.
+        """
+        rate_limiter = TokenBucketRateLimiter('test', rate=10, capacity=5)
+        self.assertEqual([self.take(rate_limiter) for _ in range(5)], [0] * 5)
+        self.assertEqual(self.take(rate_limiter), 100)
+
+    def test_refill_rate(self):
+        """
+        Ensure the bucket is refilled with `rate` tokens per second and
+        never above its capacity.
+        """
+        rate_limiter = TokenBucketRateLimiter('test', rate=10, capacity=5)
+        for _ in range(5):
+            self.take(rate_limiter)
+
+        self.now += 0.25
+        self.assertEqual([self.take(rate_limiter) for _ in range(2)], [0, 0])
+        self.assertEqual(self.take(rate_limiter), 50)
+
+        self.now += 60
+        self.assertEqual([self.take(rate_limiter) for _ in range(5)], [0] * 5)
+        self.assertEqual(self.take(rate_limiter), 100)
+
+    def test_acquire_waits_for_token(self):
+        """
+        Ensure acquire() sleeps for the wait returned by the script once the
+        bucket is empty.
+        """
+        rate_limiter = TokenBucketRateLimiter('test', rate=4, capacity=1)
+        rate_limiter.acquire()
+        self.assertEqual(self.sleeps, [])
+
+        rate_limiter.acquire()
+        self.assertEqual(self.sleeps, [0.25])
+
+    def test_block_pauses_acquire(self):
+        """
+        Ensure acquire() waits until a block() set by any worker expires.
+        """
+        rate_limiter = TokenBucketRateLimiter('test', rate=10, capacity=5)
+        rate_limiter.block(2)
+        self.assertEqual(self.take(rate_limiter), 2000)
+
+        rate_limiter.acquire()
+        self.assertEqual(sum(self.sleeps), 2)
+        self.assertEqual(self.take(rate_limiter), 0)
+
+
+class MessageStatusWriterTests(TestCase):
+
+    def test_statuses_flushed_in_batches(self):
+        """
+        Ensure statuses are written with one query per flush_size results
+        and the rest is flushed on exit.
+        """
+        newsletter = _create_newsletter()
+        messages = [
+            _create_message(newsletter, _create_customer(phone_number=f'7999123456{i}'))
+            for i in range(5)
+        ]
+        with self.assertNumQueries(3):
+            with MessageStatusWriter(flush_size=2, flush_interval=60_000) as status_writer:
+                for message in messages:
+                    status_writer.add(message.id, Message.Status.SUCCESS)
+
+        self.assertEqual(
+            Message.objects.filter(status=Message.Status.SUCCESS).count(), 5)
+
+
+class NewsletterStatsTests(TestCase):
+
+    def test_stats_follow_message_status(self):
+        """
+        Ensure counters move when a message status changes.
+        """
+        newsletter = _create_newsletter()
+        message = _create_message(newsletter, _create_customer())
+        message.status = Message.Status.SUCCESS
+        message.save()
+
+        stats = NewsletterStats.objects.get(newsletter=newsletter)
+        self.assertEqual((stats.success, stats.ongoing), (1, 0))
+
+    def test_stats_follow_customer_delete(self):
+        """
+        Ensure counters drop the messages deleted along with customers.
+        """
+        newsletter = _create_newsletter()
+        customers = [_create_customer(phone_number=f'7999123456{i}') for i in range(3)]
+        for customer in customers:
+            _create_message(newsletter, customer, Message.Status.SUCCESS)
+
+        customers[0].delete()
+        Customer.objects.filter(id__in=[customers[1].id, customers[2].id]).delete()
+
+        stats = NewsletterStats.objects.get(newsletter=newsletter)
+        self.assertEqual((stats.success, stats.total), (0, 0))
+
+    def test_newsletter_str_without_stats(self):
+        """
+        Ensure a newsletter is printed without querying its counters.
+        """
+        newsletter = Newsletter.objects.get(id=_create_newsletter().id)
+        with self.assertNumQueries(0):
+            self.assertNotIn('messages', str(newsletter))
+        newsletters = Newsletter.objects.select_related('stats')
+        self.assertIn('messages: 0', str(newsletters.get(id=newsletter.id)))
+
+        NewsletterStats.objects.filter(newsletter=newsletter).delete()
+        self.assertNotIn('messages', str(newsletters.get(id=newsletter.id)))
+
+    def test_reconcile_newsletter_stats_command(self):
+        """
+        Ensure counters are recomputed from messages written around the
+        dispatch path.
+        """
+        newsletter = _create_newsletter()
+        Message.objects.bulk_create(
+            Message(
+                newsletter=newsletter,
+                customer=_create_customer(phone_number=f'7999123456{i}'),
+                status=Message.Status.FAILURE,
+            )
+            for i in range(3)
+        )
+        NewsletterStats.objects.filter(newsletter=newsletter).delete()
+        call_command('reconcile_newsletter_stats', stdout=io.StringIO())
+
+        stats = NewsletterStats.objects.get(newsletter=newsletter)
+        self.assertEqual((stats.success, stats.failure), (0, 3))
+
+
+class MessagePartitionTests(TestCase):
+
+    def test_create_message_partitions(self):
+        """
+        Ensure monthly partitions are created ahead once.
+        """
+        created = partitions.create_message_partitions(months_ahead=3)
+        month_start = partitions.get_month_start(timezone.now(), 3)
+        self.assertIn(f'mailing_message_p{month_start:%Y_%m}', created)
+        self.assertEqual(partitions.create_message_partitions(months_ahead=3), [])
+
+    def test_archive_messages_command(self):
+        """
+        Ensure old partitions are compacted into per-newsletter counters
+        which the stats reconciliation keeps counting.
+        """
+        newsletter = _create_newsletter()
+        for i, message_status in enumerate([Message.Status.SUCCESS, Message.Status.SUCCESS, Message.Status.DEAD]):
+            _create_message(newsletter, _create_customer(phone_number=f'7999123456{i}'), message_status)
+
+        # the current month is archived too with a negative retention
+        call_command('archive_messages', months=-1, stdout=io.StringIO())
+
+        self.assertFalse(Message.objects.exists())
+        archive = MessageArchive.objects.get(newsletter=newsletter)
+        self.assertEqual((archive.success, archive.dead), (2, 1))
+        NewsletterStats.objects.reconcile([newsletter.id])
+        stats = NewsletterStats.objects.get(newsletter=newsletter)
+        self.assertEqual((stats.success, stats.dead), (2, 1))
+
+
+class AdminTests(TestCase):
+
+    def setUp(self):
+        self.client.force_login(
+            get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.newsletter = _create_newsletter()
+
+    def _get_changelist_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_changelists_queries_are_constant(self):
+        """
+        Ensure the number of changelist queries doesn't depend on the
+        number of rows.
+        """
+        message_url = reverse('admin:mailing_message_changelist')
+        newsletter_url = reverse('admin:mailing_newsletter_changelist')
+        _create_message(self.newsletter, _create_customer(phone_number='79991234560'))
+        message_queries = self._get_changelist_queries(message_url)
+        newsletter_queries = self._get_changelist_queries(newsletter_url)
+
+        for i in range(1, 5):
+            newsletter = _create_newsletter()
+            _create_message(newsletter, _create_customer(phone_number=f'7999123456{i}'))
+
+        self.assertEqual(self._get_changelist_queries(message_url), message_queries)
+        self.assertEqual(self._get_changelist_queries(newsletter_url), newsletter_queries)
+
+    def test_newsletter_filter_choices_are_limited(self):
+        """
+        Ensure the message newsletter filter offers the recent newsletters
+        and the selected one only.
+        """
+        newsletters = [self.newsletter, *(_create_newsletter() for _ in range(3))]
+        url = reverse('admin:mailing_message_changelist')
+
+        def get_choices(**params):
+            response = self.client.get(url, params)
+            newsletter_filter, = (
+                filter_spec for filter_spec in response.context['cl'].filter_specs
+                if isinstance(filter_spec, NewsletterListFilter)
+            )
+            return [newsletter_id for newsletter_id, _ in newsletter_filter.lookup_choices]
+
+        with mock.patch.object(NewsletterListFilter, 'choices_limit', 2):
+            self.assertEqual(get_choices(), [newsletters[3].id, newsletters[2].id])
+            self.assertEqual(
+                get_choices(newsletter__id__exact=newsletters[0].id),
+                [newsletters[3].id, newsletters[2].id, newsletters[0].id],
+            )
+
+    def test_approximate_count(self):
+        """
+        Ensure large unfiltered changelists are counted from the planner
+        statistics.
+        """
+        _create_message(self.newsletter, _create_customer())
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {Message._meta.db_table}')
+
+        paginator = ApproximateCountPaginator(Message.objects.order_by('id'), 100)
+        paginator.approximate_count_threshold = 0
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 1)
+        self.assertIn('reltuples', queries[0]['sql'])
+
+        filtered_paginator = ApproximateCountPaginator(Message.objects.filter(status=Message.Status.DEAD), 100)
+        filtered_paginator.approximate_count_threshold = 0
+        self.assertEqual(filtered_paginator.count, 0)
+
+
+class MessageTemplateTests(TestCase):
+
+    def test_render_message_template(self):
+        """
+        Ensure placeholders are rendered from the recipient tuple and the
+        send time in the recipient time zone.
+        """
+        message_template = MessageTemplate('{tag} {mobile_operator_code} {local_time} {{tag}}')
+        recipient = Recipient(1, '79991234567', '903', 'gamer', zoneinfo.ZoneInfo('Asia/Bangkok'))
+        now = datetime(2023, 10, 1, 12, 30, tzinfo=dt_timezone.utc)
+
+        self.assertEqual(message_template.render(recipient, now), 'gamer 903 19:30 {tag}')
+
+    def test_invalid_message_template(self):
+        """
+        Ensure unknown placeholders, format specs and unbalanced braces
+        are rejected.
+        """
+        for text in ('{name}', '{}', '{tag:>10}', '{tag', 'tag}'):
+            with self.assertRaises(TemplateError):
+                MessageTemplate(text)
+
+    def test_escaped_message_template(self):
+        """
+        Ensure an escaped text is rendered as it was written and the
+        errors explain how to escape braces.
+        """
+        recipient = Recipient(1, '79991234567', '903', 'gamer', zoneinfo.ZoneInfo('Asia/Bangkok'))
+        with self.assertRaisesMessage(TemplateError, ESCAPING_HINT):
+            MessageTemplate('Promo {SALE}')
+
+        message_template = MessageTemplate(escape('Promo {SALE} {tag}}'))
+        self.assertEqual(message_template.render(recipient, timezone.now()), 'Promo {SALE} {tag}}')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ResponseCacheTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_customer_detail_is_cached(self):
+        """
+        Ensure a repeated customer detail request and a request with a
+        matching If-None-Match are served without queries.
+        """
+        customer = _create_customer()
+        url = reverse('customer-detail', kwargs={'pk': customer.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['phone_number'], customer.phone_number)
+        self.assertEqual(response['ETag'], etag)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_customer_detail_is_invalidated(self):
+        """
+        Ensure an updated or deleted customer is not served from the cache.
+        """
+        customer = _create_customer()
+        url = reverse('customer-detail', kwargs={'pk': customer.id})
+        etag = self.client.get(url)['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {'tag': 'reader'}, format='json')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['tag'], 'reader')
+        self.assertNotEqual(response['ETag'], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_newsletter_detail_is_invalidated(self):
+        """
+        Ensure the newsletter detail is refreshed when the newsletter changes.
+        """
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            newsletter = _create_newsletter(start=now + timedelta(days=1), finish=now + timedelta(days=2))
+        url = reverse('newsletter-detail', kwargs={'pk': newsletter.id})
+        self.assertEqual(self.client.get(url).json()['message_text'], newsletter.message_text)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(url, {'message_text': 'Text after update'}, format='json')
+        self.assertEqual(self.client.get(url).json()['message_text'], 'Text after update')
+
+    def test_newsletter_detail_is_invalidated_on_bulk_delete(self):
+        """
+        Ensure newsletters deleted through a queryset, as the admin action
+        does, are not served from the cache.
+        """
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            newsletter = _create_newsletter(start=now + timedelta(days=1), finish=now + timedelta(days=2))
+        url = reverse('newsletter-detail', kwargs={'pk': newsletter.id})
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Newsletter.objects.filter(id=newsletter.id).delete()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_newsletter_detail_is_kept_on_customer_change(self):
+        """
+        Ensure a customer joining a newsletter doesn't invalidate its
+        detail, the audience is served by the customers action.
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            newsletter = _create_newsletter(finish=timezone.now() + timedelta(days=1))
+        url = reverse('newsletter-detail', kwargs={'pk': newsletter.id})
+        self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            customer = _create_customer()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        response = self.client.get(reverse('newsletter-customers', kwargs={'pk': newsletter.id}))
+        self.assertEqual([item['id'] for item in response.json()['results']], [customer.id])
+
+
+class DeliveryReportTests(APITestCase):
+
+    def setUp(self):
+        self.newsletter = _create_newsletter()
+        self.customers = [_create_customer(phone_number=f'7999123456{i}') for i in range(3)]
+        for customer, message_status in zip(self.customers, [Message.Status.SUCCESS, Message.Status.FAILURE]):
+            _create_message(self.newsletter, customer, message_status)
+
+    def test_report_csv(self):
+        """
+        Ensure the report streams every message of a newsletter as CSV.
+        """
+        url = reverse('newsletter-report', kwargs={'pk': self.newsletter.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(
+            [(row['phone_number'], row['status']) for row in rows],
+            [('79991234560', 'success'), ('79991234561', 'failure')],
+        )
+
+    def test_report_ndjson(self):
+        """
+        Ensure the report streams one JSON object per message as NDJSON.
+        """
+        url = reverse('newsletter-report', kwargs={'pk': self.newsletter.id})
+        response = self.client.get(url, {'file_format': 'ndjson'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(
+            [(row['customer_id'], row['status'], row['attempts']) for row in rows],
+            [(self.customers[0].id, 'success', 0), (self.customers[1].id, 'failure', 0)],
+        )
+
+        response = self.client.get(url, {'file_format': 'xml'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_delivery_report_command(self):
+        """
+        Ensure the command writes the report to stdout.
+        """
+        stdout = io.StringIO()
+        call_command('export_delivery_report', self.newsletter.id, stdout=stdout)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], 'message_id,customer_id,phone_number,status,attempts,created_at,updated_at')
+        self.assertEqual(len(lines), 3)
+
+
+class AsyncViewsTests(TestCase):
+
+    def setUp(self):
+        self.customers = [_create_customer(phone_number=f'7999123456{i}') for i in range(3)]
+        self.newsletters = [
+            _create_newsletter(start=timezone.now(), finish=timezone.now() + timedelta(days=1))
+            for _ in range(3)
+        ]
+
+    async def test_newsletter_list(self):
+        """
+        Ensure the async newsletter list is paginated by id and counts
+        the customers of every newsletter.
+        """
+        url = reverse('async-newsletter-list')
+        response = await self.async_client.get(url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        page = response.json()
+        self.assertEqual([newsletter['id'] for newsletter in page['results']], [n.id for n in self.newsletters[:2]])
+        self.assertEqual(page['results'][0]['customers_count'], 3)
+
+        response = await self.async_client.get(page['next'])
+        page = response.json()
+        self.assertEqual([newsletter['id'] for newsletter in page['results']], [self.newsletters[2].id])
+        self.assertIsNone(page['next'])
+
+    async def test_newsletter_stats(self):
+        """
+        Ensure the async stats view returns the counters of a newsletter.
+        """
+        url = reverse('async-newsletter-stats-detail', kwargs={'pk': self.newsletters[0].id})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['success'], 0)
+
+        url = reverse('async-newsletter-stats-detail', kwargs={'pk': 0})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    async def test_customer_lookup(self):
+        """
+        Ensure customers are looked up by id and by phone number, and
+        the async views are read-only.
+        """
+        url = reverse('async-customer-detail', kwargs={'pk': self.customers[1].id})
+        response = await self.async_client.get(url)
+        self.assertEqual(response.json()['phone_number'], '79991234561')
+
+        url = reverse('async-customer-lookup')
+        response = await self.async_client.get(url, {'phone_number': '79991234562'})
+        self.assertEqual(response.json()['id'], self.customers[2].id)
+
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = await self.async_client.post(url, {'phone_number': '79991234562'})
+        self.assertEqual(response.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+class DispatchBenchmarkTests(TestCase):
+
+    def test_benchmark_dispatch_command(self):
+        """
+        Ensure the benchmark sends every seeded message, reports its
+        metrics and leaves no data behind.
+        """
+        stdout = io.StringIO()
+        call_command('benchmark_dispatch', customers=20, newsletters=2, error_rate=0.5, stdout=stdout)
+
+        self.assertIn('messages: 40', stdout.getvalue())
+        self.assertIn('queries/message', stdout.getvalue())
+        self.assertIn('latency p99', stdout.getvalue())
+        self.assertIn('peak memory growth', stdout.getvalue())
+        self.assertFalse(Customer.objects.exists())
+        self.assertFalse(Newsletter.objects.exists())
+
+    def test_benchmark_message_template_command(self):
+        """
+        Ensure the template benchmark reports the render cost.
+        """
+        stdout = io.StringIO()
+        call_command('benchmark_message_template', 'Hi, {tag}!', messages=10, stdout=stdout)
+
+        self.assertIn('per 10 messages', stdout.getvalue())
+
+
 def _create_customer(
         phone_number: str = '79991234567',
         mobile_operator_code: str = '903',
@@ -1,7 +1,7 @@
 from django.urls import include, path
 from rest_framework import routers
 
-from . import views
+from . import async_views, views
 
 router = routers.DefaultRouter()
 router.register(r'customers', views.CustomerViewSet)
@@ -10,4 +10,15 @@ router.register(r'newsletter_stats', views.NewsletterStatsViewSet, basename='new
 
 urlpatterns = [
     path('', include(router.urls)),
+    # read-only async counterparts of the endpoints polled the most,
+    # served without blocking by the web-async service
+    path('async/newsletters/', async_views.NewsletterListView.as_view(), name='async-newsletter-list'),
+    path('async/newsletter_stats/', async_views.NewsletterStatsView.as_view(), name='async-newsletter-stats-list'),
+    path(
+        'async/newsletter_stats/<int:pk>/',
+        async_views.NewsletterStatsView.as_view(),
+        name='async-newsletter-stats-detail',
+    ),
+    path('async/customers/', async_views.CustomerView.as_view(), name='async-customer-lookup'),
+    path('async/customers/<int:pk>/', async_views.CustomerView.as_view(), name='async-customer-detail'),
 ]
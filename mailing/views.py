@@ -1,26 +1,123 @@
-from django.db.models import Count, Q
-from rest_framework import viewsets
+import dataclasses
+import io
 
-from .models import Customer, Message, Newsletter
-from .serializers import (CustomerSerializer, NewsletterSerializer,
-                          NewsletterStatsSerializer)
+from django.db.models import (Case, Count, IntegerField, OuterRef, QuerySet,
+                              Subquery, Value, When)
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
 
+from .customer_import import import_customers
+from .delivery_report import CONTENT_TYPES, iter_delivery_report
+from .models import Customer, Newsletter
+from .response_cache import CachedRetrieveMixin
+from .serializers import (CustomerBulkUpdateSerializer,
+                          CustomerImportSerializer, CustomerSerializer,
+                          DeliveryReportSerializer, NewsletterListSerializer,
+                          NewsletterSerializer, NewsletterStatsSerializer)
 
-class CustomerViewSet(viewsets.ModelViewSet):
+
+def annotate_customers_count(queryset: QuerySet[Newsletter]) -> QuerySet[Newsletter]:
+    # a correlated subquery is evaluated only for the newsletters
+    # of the current page
+    members_count = (
+        Newsletter.customers.through.objects
+        .filter(newsletter=OuterRef('pk'))
+        .order_by()
+        .values('newsletter')
+        .annotate(count=Count('*'))
+        .values('count')
+    )
+    return queryset.annotate(customers_count=Case(
+        # a dynamic audience has no members and counting its filter would
+        # scan the customers for every newsletter of the page
+        When(dynamic_audience=True, then=Value(None)),
+        default=Coalesce(Subquery(members_count), 0),
+        output_field=IntegerField(),
+    ))
+
+
+class CustomerViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
     serializer_class = CustomerSerializer
     queryset = Customer.objects.all()
+    response_cache_name = 'customer'
 
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path='import',
+        serializer_class=CustomerImportSerializer,
+        parser_classes=[MultiPartParser],
+    )
+    def bulk_import(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result = import_customers(
+            io.TextIOWrapper(serializer.validated_data['file'].file, encoding='utf-8-sig', newline=''),
+            serializer.validated_data['file_format'],
+        )
+        return Response(dataclasses.asdict(result), status=status.HTTP_200_OK)
+
+    @action(
+        detail=False,
+        methods=['patch'],
+        url_path='bulk',
+        serializer_class=CustomerBulkUpdateSerializer,
+    )
+    def bulk_update(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        fields = dict(serializer.validated_data)
+        customer_ids = fields.pop('ids')
+        updated = Customer.objects.filter(id__in=customer_ids).resegment(**fields)
+        return Response({'updated': updated}, status=status.HTTP_200_OK)
 
-class NewsletterViewSet(viewsets.ModelViewSet):
+
+class NewsletterViewSet(CachedRetrieveMixin, viewsets.ModelViewSet):
     serializer_class = NewsletterSerializer
     queryset = Newsletter.objects.all()
+    response_cache_name = 'newsletter'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = annotate_customers_count(queryset)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return NewsletterListSerializer
+        return super().get_serializer_class()
+
+    @action(detail=True, serializer_class=CustomerSerializer)
+    def customers(self, request, pk=None):
+        newsletter = self.get_object()
+        page = self.paginate_queryset(newsletter.get_audience())
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, serializer_class=DeliveryReportSerializer)
+    def report(self, request, pk=None):
+        newsletter = self.get_object()
+        serializer = self.get_serializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        file_format = serializer.validated_data['file_format']
+        # rows are fetched from a server-side cursor while the response is
+        # written, whatever the number of messages is
+        response = StreamingHttpResponse(
+            iter_delivery_report(newsletter.id, file_format),
+            content_type=CONTENT_TYPES[file_format],
+        )
+        response['Content-Disposition'] = f'attachment; filename="newsletter-{newsletter.id}.{file_format}"'
+        # nginx passes the rows through instead of buffering the whole report
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 class NewsletterStatsViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = NewsletterStatsSerializer
-    queryset = Newsletter.objects.prefetch_related('messages').annotate(
-        success=Count('pk', filter=Q(messages__status=Message.Status.SUCCESS)),
-        ongoing=Count('pk', filter=Q(messages__status=Message.Status.ONGOING)),
-        failure=Count('pk', filter=Q(messages__status=Message.Status.FAILURE)),
-        canceled=Count('pk', filter=Q(messages__status=Message.Status.CANCELED)),
-    )
+    # counters are maintained by the dispatch path, see NewsletterStats
+    queryset = Newsletter.objects.select_related('stats')